@@ -1,18 +1,24 @@
+import asyncio
 import os
 import pathlib
 import re
-from random import choice
-from typing import List
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from functools import partial
+from typing import List, Dict, Tuple, Optional, TYPE_CHECKING
 
 from modules.shared import (
     get_pwd,
     AbstractPlugin,
-    explore_folder,
-    download_file,
     compress_image_max_vol,
-    generate_random_string,
 )
 
+if TYPE_CHECKING:
+    from .select import Selector
+    from .compress_cache import CompressCache
+
 __all__ = ["PicEval"]
 
 
@@ -32,9 +38,11 @@ class Default:
 class PicEval(AbstractPlugin):
     CONFIG_PICTURE_ASSET_PATH = "PictureAssetPath"
     CONFIG_PICTURE_IGNORED_DIRS = "PictureIgnored"
+    CONFIG_PICTURE_ASSET_WEIGHTS = "PictureAssetWeights"
     CONFIG_PICTURE_CACHE_DIR_PATH = "PictureCacheDirPath"
     CONFIG_STORE_DIR_PATH = "StoreDirPath"
     CONFIG_LEVEL_RESOLUTION = "LevelResolution"
+    CONFIG_LEVEL_MIGRATE = "LevelMigrate"
 
     CONFIG_DETECTED_KEYWORD = "DetectedKeyword"
 
@@ -46,18 +54,87 @@ class PicEval(AbstractPlugin):
 
     CONFIG_MAX_BATCH_SIZE = "MaxBatchSize"
 
-    Default.create_folders()
+    CONFIG_COMPRESS_WORKERS = "CompressWorkers"
+    CONFIG_COMPRESS_QUEUE_SIZE = "CompressQueueSize"
+    CONFIG_COMPRESS_CACHE_SIZE = "CompressCacheSize"
+    CONFIG_FAST_COMPRESS = "FastCompress"
+
+    CONFIG_CACHE_MAX_SIZE = "CacheMaxSize"
+    CONFIG_CACHE_MAX_FILES = "CacheMaxFiles"
+    CONFIG_CACHE_MAX_AGE = "CacheMaxAge"
+    CONFIG_CACHE_CLEAN_INTERVAL = "CacheCleanInterval"
+
+    CONFIG_VOTE_QUORUM = "VoteQuorum"
+    CONFIG_VOTE_SETTLE_SECONDS = "VoteSettleSeconds"
+    CONFIG_VOTE_AGGREGATE = "VoteAggregate"
+
+    CONFIG_DEDUP_ENABLED = "DedupEnabled"
+    CONFIG_DEDUP_RADIUS = "DedupRadius"
+    CONFIG_DEDUP_WORKERS = "DedupWorkers"
+
+    CONFIG_SELECT_STRATEGY = "SelectStrategy"
+    CONFIG_SELECT_SCORE_EXPONENT = "SelectScoreExponent"
+
+    CONFIG_INDEX_WATCH = "IndexWatch"
+    CONFIG_INDEX_POLL_INTERVAL = "IndexPollInterval"
+    CONFIG_INDEX_WORKERS = "IndexWorkers"
+
+    CONFIG_PREFETCH_DEPTH = "PrefetchDepth"
+    CONFIG_WARM_POOL_SIZE = "WarmPoolSize"
+    CONFIG_WARM_POOL_REFILL_INTERVAL = "WarmPoolRefillInterval"
+
+    CONFIG_SCORE_TOP_KEYWORD = "ScoreTopKeyword"
+    CONFIG_SCORE_STATS_KEYWORD = "ScoreStatsKeyword"
+
+    CONFIG_METRICS_KEYWORD = "MetricsKeyword"
+    CONFIG_METRICS_EXPORT_PATH = "MetricsExportPath"
+    CONFIG_METRICS_EXPORT_INTERVAL = "MetricsExportInterval"
+
+    _selector: Optional["Selector"] = None
+    _selector_ready: Optional[Future] = None
+    _compress_cache: Optional["CompressCache"] = None
+    _shared_lock = threading.Lock()
+
     DefaultConfig = {
         CONFIG_PICTURE_ASSET_PATH: Default.asset,
         CONFIG_RECYCLE_FOLDER: Default.recycle,
         CONFIG_PICTURE_CACHE_DIR_PATH: Default.cache,
         CONFIG_STORE_DIR_PATH: Default.store,
         CONFIG_PICTURE_IGNORED_DIRS: [],
+        CONFIG_PICTURE_ASSET_WEIGHTS: {},
         CONFIG_DETECTED_KEYWORD: "eval",
         CONFIG_RAND_KEYWORD: "ej",
         CONFIG_LEVEL_RESOLUTION: 10,
+        CONFIG_LEVEL_MIGRATE: False,
         CONFIG_MAX_FILE_SIZE: 6 * 1024 * 1024,
         CONFIG_MAX_BATCH_SIZE: 7,
+        CONFIG_COMPRESS_WORKERS: 2,
+        CONFIG_COMPRESS_QUEUE_SIZE: 16,
+        CONFIG_COMPRESS_CACHE_SIZE: 512 * 1024 * 1024,
+        CONFIG_FAST_COMPRESS: True,
+        CONFIG_CACHE_MAX_SIZE: 2 * 1024 * 1024 * 1024,
+        CONFIG_CACHE_MAX_FILES: 20000,
+        CONFIG_CACHE_MAX_AGE: 7 * 24 * 3600,
+        CONFIG_CACHE_CLEAN_INTERVAL: 600,
+        CONFIG_VOTE_QUORUM: 3,
+        CONFIG_VOTE_SETTLE_SECONDS: 600,
+        CONFIG_VOTE_AGGREGATE: "mean",
+        CONFIG_DEDUP_ENABLED: False,
+        CONFIG_DEDUP_RADIUS: 4,
+        CONFIG_DEDUP_WORKERS: 2,
+        CONFIG_SELECT_STRATEGY: "uniform",
+        CONFIG_SELECT_SCORE_EXPONENT: 2.0,
+        CONFIG_INDEX_WATCH: "off",
+        CONFIG_INDEX_POLL_INTERVAL: 300,
+        CONFIG_INDEX_WORKERS: 4,
+        CONFIG_PREFETCH_DEPTH: 2,
+        CONFIG_WARM_POOL_SIZE: 0,
+        CONFIG_WARM_POOL_REFILL_INTERVAL: 5,
+        CONFIG_SCORE_TOP_KEYWORD: "top",
+        CONFIG_SCORE_STATS_KEYWORD: "stats",
+        CONFIG_METRICS_KEYWORD: "metrics",
+        CONFIG_METRICS_EXPORT_PATH: "",
+        CONFIG_METRICS_EXPORT_INTERVAL: 60,
     }
 
     @classmethod
@@ -85,15 +162,42 @@ class PicEval(AbstractPlugin):
         from graia.ariadne.util.cooldown import CoolDown
         from graia.ariadne.event.message import GroupMessage, ActiveGroupMessage, MessageEvent
         from graia.ariadne.exception import UnknownTarget
+        from graia.ariadne.event.lifecycle import ApplicationLaunched
 
         from .select import Selector
-        from .evaluate import Evaluate
+        from .evaluate import Evaluate, VoteAggregator
         from .img_manager import ImageRegistry
-
-        img_registry = ImageRegistry(
-            f"{get_pwd()}/images_registry.json",
-            recycle_folder=self._config_registry.get_config(self.CONFIG_RECYCLE_FOLDER),
-        )
+        from .compressor import ImageCompressor, CompressorBusy
+        from .compress_cache import CompressCache
+        from .fast_compress import QualityHints
+        from .cache_manager import CacheManager
+        from .fetcher import ImageFetcher
+        from .dedup import PHashIndex
+        from .strategies import SelectStrategy, ScoreWeightedStrategy, NoRepeatStrategy
+        from .watcher import IndexWatcher
+        from .pipeline import PicturePipeline
+        from .metrics import metrics, logger, JsonFileExporter
+        from .migration import StoreMigration
+
+        timings: List[Tuple[str, float]] = []
+
+        @contextmanager
+        def startup_phase(name: str):
+            start = time.perf_counter()
+            yield
+            timings.append((name, time.perf_counter() - start))
+
+        def report(phases: List[Tuple[str, float]]) -> str:
+            return ", ".join(f"{name} {elapsed * 1000:.0f}ms" for name, elapsed in phases)
+
+        with startup_phase("folders"):
+            Default.create_folders()
+        with startup_phase("registry"):
+            img_registry = ImageRegistry(
+                f"{get_pwd()}/images_registry.db",
+                recycle_folder=self._config_registry.get_config(self.CONFIG_RECYCLE_FOLDER),
+                legacy_path=f"{get_pwd()}/images_registry.json",
+            )
         ignored: List[str] = self._config_registry.get_config(self.CONFIG_PICTURE_IGNORED_DIRS)
         cache_dir_path: str = self._config_registry.get_config(self.CONFIG_PICTURE_CACHE_DIR_PATH)
         asset_dir_paths: List[str] = self._config_registry.get_config(self.CONFIG_PICTURE_ASSET_PATH)
@@ -101,9 +205,160 @@ class PicEval(AbstractPlugin):
         pathlib.Path(store_dir_path).mkdir(parents=True, exist_ok=True)
         level_resolution: int = self._config_registry.get_config(self.CONFIG_LEVEL_RESOLUTION)
         max_batch_size: int = self._config_registry.get_config(self.CONFIG_MAX_BATCH_SIZE)
+        max_file_size: int = self._config_registry.get_config(self.CONFIG_MAX_FILE_SIZE)
 
-        selector: Selector = Selector(asset_dirs=asset_dir_paths, cache_dir=cache_dir_path, ignore_dirs=ignored)
-        evaluator: Evaluate = Evaluate(store_dir_path=store_dir_path, level_resolution=level_resolution)
+        migration = StoreMigration(
+            store_dir_path,
+            level_resolution,
+            progress=lambda moved, total: logger.info("migrated %d/%d files", moved, total),
+        )
+        # a migration that was interrupted is always finished, the store is unusable in between
+        if migration.pending or (self._config_registry.get_config(self.CONFIG_LEVEL_MIGRATE) and migration.needed()):
+            with startup_phase("migration"):
+                old_resolution, moved = migration.run()
+            print(f"{Fore.YELLOW}migrated {moved} files from {old_resolution} to {level_resolution} levels{Fore.RESET}")
+        with startup_phase("evaluator"):
+            evaluator: Evaluate = Evaluate(store_dir_path=store_dir_path, level_resolution=level_resolution)
+        strategy_name: str = self._config_registry.get_config(self.CONFIG_SELECT_STRATEGY)
+        strategy: SelectStrategy
+        if strategy_name == "weighted":
+            mid_score = sum(evaluator.score_bound) / 2
+            exponent: float = self._config_registry.get_config(self.CONFIG_SELECT_SCORE_EXPONENT)
+            strategy = ScoreWeightedStrategy(weight_of=lambda score: (score / mid_score) ** exponent)
+        elif strategy_name == "no_repeat":
+            strategy = NoRepeatStrategy()
+        else:
+            strategy = SelectStrategy()
+        with startup_phase("compress cache"):
+            compress_cache: CompressCache = CompressCache(
+                cache_dir=f"{cache_dir_path}/compressed",
+                max_bytes=self._config_registry.get_config(self.CONFIG_COMPRESS_CACHE_SIZE),
+            )
+        selector_ready: Future = Future()
+        with self._shared_lock:
+            self._selector, self._selector_ready, self._compress_cache = None, selector_ready, compress_cache
+
+        def load_selector():
+            """
+            Seeds the strategy and loads the index off the startup path, then resolves ``selector_ready``.
+            """
+            phases: List[Tuple[str, float]] = []
+            try:
+                start = time.perf_counter()
+                evaluator.score_index.reconcile()
+                phases.append(("score index", time.perf_counter() - start))
+                start = time.perf_counter()
+                if isinstance(strategy, ScoreWeightedStrategy):
+                    asset_prefixes = tuple(os.path.join(asset_dir, "") for asset_dir in asset_dir_paths)
+                    for source, score in evaluator.scores().items():
+                        if source.startswith(asset_prefixes):
+                            strategy.set_score(source, score)
+                    phases.append(("scores", time.perf_counter() - start))
+                    start = time.perf_counter()
+                selector: Selector = Selector(
+                    asset_dirs=asset_dir_paths,
+                    cache_dir=cache_dir_path,
+                    ignore_dirs=ignored,
+                    strategy=strategy,
+                    weights=self._config_registry.get_config(self.CONFIG_PICTURE_ASSET_WEIGHTS),
+                    workers=self._config_registry.get_config(self.CONFIG_INDEX_WORKERS),
+                )
+                phases.append(("index", time.perf_counter() - start))
+            except Exception as e:
+                print(f"{Fore.RED}PicEval index failed to load: {e}{Fore.RESET}")
+                selector_ready.set_exception(e)
+                return
+            with self._shared_lock:
+                self._selector = selector
+            index_watch: str = self._config_registry.get_config(self.CONFIG_INDEX_WATCH)
+            if index_watch in ("inotify", "poll"):
+                IndexWatcher(
+                    selector,
+                    poll_interval=self._config_registry.get_config(self.CONFIG_INDEX_POLL_INTERVAL),
+                    use_inotify=index_watch == "inotify",
+                ).start()
+            selector_ready.set_result(selector)
+            print(f"{Fore.CYAN}PicEval index ready: {report(phases)}{Fore.RESET}")
+
+        threading.Thread(target=load_selector, name="PicEval-index-loader", daemon=True).start()
+        compressor: ImageCompressor = ImageCompressor(
+            max_workers=self._config_registry.get_config(self.CONFIG_COMPRESS_WORKERS),
+            max_pending=self._config_registry.get_config(self.CONFIG_COMPRESS_QUEUE_SIZE),
+            cache=compress_cache,
+            fast=self._config_registry.get_config(self.CONFIG_FAST_COMPRESS),
+            hints=QualityHints(save_path=f"{cache_dir_path}/quality_hints.json"),
+        )
+        fetcher: ImageFetcher = ImageFetcher(cache_dir=cache_dir_path, registry=img_registry)
+        with startup_phase("votes"):
+            aggregator: VoteAggregator = VoteAggregator(
+                save_path=f"{get_pwd()}/pending_votes.json",
+                score_bound=evaluator.score_bound,
+                quorum=self._config_registry.get_config(self.CONFIG_VOTE_QUORUM),
+                settle_seconds=self._config_registry.get_config(self.CONFIG_VOTE_SETTLE_SECONDS),
+                aggregate=self._config_registry.get_config(self.CONFIG_VOTE_AGGREGATE),
+            )
+
+        dedup: Optional[PHashIndex] = None
+        if self._config_registry.get_config(self.CONFIG_DEDUP_ENABLED):
+            with startup_phase("dedup"):
+                dedup = PHashIndex(
+                    save_path=f"{get_pwd()}/phash_index.bin",
+                    roots=asset_dir_paths + [store_dir_path],
+                    radius=self._config_registry.get_config(self.CONFIG_DEDUP_RADIUS),
+                    workers=self._config_registry.get_config(self.CONFIG_DEDUP_WORKERS),
+                    within=asset_dir_paths,
+                )
+            threading.Thread(target=dedup.update, name="PicEval-dedup", daemon=True).start()
+
+        def skip_duplicate(path: str) -> bool:
+            return dedup.is_redundant(path)
+
+        skip = skip_duplicate if dedup else None
+        pipeline: PicturePipeline = PicturePipeline(
+            select=lambda group_id: selector_ready.result().random_select(group=group_id, skip=skip),
+            compress=lambda picture: compressor.compress_cached(picture, max_file_size),
+            prefetch=self._config_registry.get_config(self.CONFIG_PREFETCH_DEPTH),
+            warm_size=self._config_registry.get_config(self.CONFIG_WARM_POOL_SIZE),
+            refill_interval=self._config_registry.get_config(self.CONFIG_WARM_POOL_REFILL_INTERVAL),
+        )
+
+        def mark_settled(marks: Dict[int, Tuple[str, int, Optional[str]]]) -> Dict[int, Optional[str]]:
+            marked: Dict[int, Optional[str]] = {}
+            for key, mark in marks.items():
+                try:
+                    moved = evaluator.mark_many([mark])
+                except Exception as e:
+                    logger.warning("failed to mark %s: %s", mark[0], e)
+                    continue
+                marked[key] = moved[0] if moved else None
+                if dedup and moved and moved[0] != mark[0]:
+                    dedup.discard(mark[0])
+                    dedup.add(moved[0])
+            return marked
+
+        late_scores: List[Tuple[str, int]] = []
+
+        def apply_scores(scores: List[Tuple[str, int]]) -> None:
+            # the loader seeds the strategy from the ledger as it was when read, later marks wait for the index
+            late_scores.extend(scores)
+            if selector_ready.done():
+                for source, score in late_scores:
+                    strategy.set_score(source, score)
+                late_scores.clear()
+
+        async def flush_votes(force: bool = False):
+            marks = aggregator.pop_settled(force=force)
+            if not marks:
+                return
+            marked: Dict[int, Optional[str]] = {}
+            try:
+                marked = await asyncio.get_running_loop().run_in_executor(None, mark_settled, marks)
+            finally:
+                # the marks that did not move go back to the pending tallies and are retried on the next flush
+                aggregator.settle(marks, marked)
+            if isinstance(strategy, ScoreWeightedStrategy):
+                apply_scores([(marks[key][2], marks[key][1]) for key, path in marked.items() if path and marks[key][2]])
+            logger.info("marked %d settled pics", sum(1 for path in marked.values() if path))
 
         from graia.ariadne import Ariadne
 
@@ -126,9 +381,13 @@ class PicEval(AbstractPlugin):
             Notes:
                 - This function is decorated with `@bord_cast.receiver`.
                 - The message is evaluated based on the score provided in the message.
-                - The origin message is retrieved using the `ariadne_app.get_message_from_id` method.
+                - Images sent by the bot are taken from their local original through the `img_registry`.
+                - Other origin messages are retrieved using the `ariadne_app.get_message_from_id` method and
+                  their media is downloaded by the `fetcher`, which shares concurrent downloads of one url.
                 - The evaluated message can be an image or a multimedia element.
-                - The evaluated message is marked with the assigned score using the `evaluator.mark` method.
+                - The score is cast as a vote through the `aggregator`, a second vote on the same image needs
+                  no fetch at all. Once the votes settle the image is moved with `evaluator.mark_many`.
+                - With dedup enabled, a new image that nearly duplicates a stored one is flagged in the group.
                 - The evaluated message and its score are sent as a group message using the `ariadne_app.send_group_message` method.
             """
             if not hasattr(event.quote, "origin"):
@@ -137,24 +396,76 @@ class PicEval(AbstractPlugin):
                 score = int(str(message.get(Plain, 1)[0]))
             except ValueError:
                 return
-            try:
-                origin_message: GroupMessage = await app.get_message_from_id(message=event.quote.id, target=group)
-            except UnknownTarget:
-                await app.send_group_message(group, "a, 这次不行")
+            if not evaluator.score_bound[0] <= score <= evaluator.score_bound[1]:
                 return
-            origin_chain: MessageChain = origin_message.message_chain
-            if Image in origin_chain:
-                print("FOUND IMAGE")
-                path = await download_file(origin_chain.get(Image, 1)[0].url, cache_dir_path)
-            elif MultimediaElement in origin_chain:
-                print("FOUND MULTIMEDIA")
-                path = await download_file(origin_chain.get(MultimediaElement, 1)[0].url, cache_dir_path)
+            key: int = event.quote.id
+            if key in aggregator:
+                tally = aggregator.vote(key, event.sender.id, score)
             else:
-                return
-
-            print(f"{Fore.GREEN}eval {score} at {path}")
-            evaluator.mark(path, score)
-            await app.send_group_message(group, f"Evaluated pic as {score}")
+                path = fetcher.resolve_local(key)
+                source = img_registry.get(key) if path else None
+                if path is None:
+                    try:
+                        origin_message: GroupMessage = await app.get_message_from_id(message=key, target=group)
+                    except UnknownTarget:
+                        await app.send_group_message(group, "a, 这次不行")
+                        return
+                    origin_chain: MessageChain = origin_message.message_chain
+                    if Image in origin_chain:
+                        logger.debug("found image in %d", key)
+                        path = await fetcher.download(origin_chain.get(Image, 1)[0].url)
+                    elif MultimediaElement in origin_chain:
+                        logger.debug("found multimedia in %d", key)
+                        path = await fetcher.download(origin_chain.get(MultimediaElement, 1)[0].url)
+                    else:
+                        return
+                duplicates = []
+                if dedup:
+                    duplicates = await asyncio.get_running_loop().run_in_executor(
+                        None, partial(dedup.duplicates, path, within=[store_dir_path])
+                    )
+                if key in aggregator:
+                    os.remove(path)
+                    path = None
+                tally = aggregator.vote(key, event.sender.id, score, path, source)
+                if duplicates:
+                    await app.send_group_message(
+                        group, f"可能重复了: {os.path.relpath(duplicates[0][1], store_dir_path)}"
+                    )
+
+            logger.info("eval %d at %s, %d votes", score, tally.path, tally.count)
+            await app.send_group_message(group, f"Evaluated pic as {score}, {tally.count} votes")
+            if aggregator.is_settled(tally):
+                await flush_votes()
+
+        @self.receiver(ApplicationLaunched)
+        async def vote_flusher():
+            async def _flush_loop():
+                while True:
+                    await asyncio.sleep(min(60.0, aggregator.settle_seconds))
+                    try:
+                        await flush_votes()
+                    except Exception as e:
+                        logger.warning("failed to flush votes: %s", e)
+
+            asyncio.ensure_future(_flush_loop())
+
+        @self.receiver(ApplicationLaunched)
+        async def score_seeder():
+            async def _apply_when_ready():
+                await asyncio.wrap_future(selector_ready)
+                apply_scores([])
+
+            if isinstance(strategy, ScoreWeightedStrategy):
+                asyncio.ensure_future(_apply_when_ready())
+
+        @self.receiver(ApplicationLaunched)
+        async def warm_pool():
+            async def _warm_when_ready():
+                await asyncio.wrap_future(selector_ready)
+                await pipeline.keep_warm()
+
+            asyncio.ensure_future(_warm_when_ready())
 
         activate_keyword: str = self._config_registry.get_config(self.CONFIG_RAND_KEYWORD)
         reg = re.compile(rf"^{activate_keyword}(?:$|\s+(\d+)$)")
@@ -171,10 +482,9 @@ class PicEval(AbstractPlugin):
             An asynchronous function that is decorated as a receiver for the "GroupMessage" event.
             This function is triggered when a group message is received and contains a keyword
             specified in the configuration.
-            It selects a random picture using the "selector"
-            object, compresses the image to a specified maximum file size using the
-            "compress_image_max_vol" function, and sends the compressed image to the group using
-            the "ariadne_app.send_group_message" function.
+            It streams random pictures from the "pipeline", which takes them from its warm pool
+            first and keeps a few compressions ahead of the uploads, and sends each compressed
+            image to the group as soon as it is ready.
 
             Parameters:
                 group (Group): The group object representing the group where the message was
@@ -191,17 +501,22 @@ class PicEval(AbstractPlugin):
             match_groups = matches.groups()
             loop_len = int(match_groups[0]) if match_groups[0] else 1
             loop_len = loop_len if loop_len <= max_batch_size else max_batch_size
-            print(f"{Fore.BLUE}Loop for {loop_len}{Fore.RESET}")
-            for _ in range(loop_len):
-                picture = selector.random_select()
-
-                output_path = f"{cache_dir_path}/{os.path.basename(picture)}"
-                quality = compress_image_max_vol(
-                    picture, output_path, self._config_registry.get_config(self.CONFIG_MAX_FILE_SIZE), False
-                )
-                print(f"Compress to {quality}")
+            logger.info("loop for %d", loop_len)
+            if not selector_ready.done():
+                logger.info("waiting for the index to load")
+            try:
+                await asyncio.wrap_future(selector_ready)
+            except Exception:
+                await app.send_group_message(group, "a, 这次不行")
+                return
 
-                await app.send_group_message(group, Image(path=output_path) + Plain(picture))
+            try:
+                async for picture, output_path in pipeline.stream(loop_len, group=group.id):
+                    with metrics.timer("upload_seconds"):
+                        await app.send_group_message(group, Image(path=output_path) + Plain(picture))
+                    metrics.counter("pictures_sent").inc()
+            except CompressorBusy:
+                await app.send_group_message(group, "太多了, 等一下再来")
 
         @self.receiver(ActiveGroupMessage)
         async def watcher(message: ActiveGroupMessage):
@@ -213,7 +528,7 @@ class PicEval(AbstractPlugin):
             if message.id != -1 and Image in chain and os.path.exists(file_path):
                 img_registry.register(message.id, file_path)
 
-                print(f"registered {message.id}, Current len = {len(img_registry.images_registry)}")
+                logger.info("registered %d, current len = %d", message.id, len(img_registry.images_registry))
 
         @self.receiver(
             GroupMessage,
@@ -227,17 +542,204 @@ class PicEval(AbstractPlugin):
             success = img_registry.remove(event.quote.id, save=True)
             await app.send_group_message(group, f"Remove id-{event.quote.id}\nSuccess = {success}")
 
-    def rand_pic(self, quality: int = 50) -> str:
-        search_stack = []
-        for folder in self.config_registry.get_config(self.CONFIG_PICTURE_ASSET_PATH):
-            search_stack.extend(explore_folder(folder))
-        cache_dir = self.config_registry.get_config(self.CONFIG_PICTURE_CACHE_DIR_PATH)
-        out_path = f"{cache_dir}/{generate_random_string(10)}.png"
-        compress_image_max_vol(
-            input_image_path=choice(search_stack),
-            output_image_path=out_path,
-            max_file_size=6 * 1024 * 1024,
-            search_best=False,
-            min_quality=quality,
+        score_index = evaluator.score_index
+        top_keyword: str = self._config_registry.get_config(self.CONFIG_SCORE_TOP_KEYWORD)
+        top_reg = re.compile(rf"^{top_keyword}(?:\s+(\d+))?(?:\s+(\d+)-(\d+))?$")
+
+        @self.receiver(
+            GroupMessage,
+            decorators=[
+                ContainKeyword(keyword=top_keyword),
+            ],
+            dispatchers=[CoolDown(5)],
+        )
+        async def score_top(app: Ariadne, group: Group, message: MessageChain):
+            """
+            Replies with the best scored pictures of the store, read from the score index.
+
+            The message is ``top [k] [low-high]``, k defaults to 10 and is capped at 30, the range filters the
+            scores, both ends included.
+            """
+            matches = re.match(top_reg, str(message))
+            if not matches:
+                return
+            count, low, high = matches.groups()
+            low_score, high_score = (int(low), int(high)) if low else (None, None)
+            records = score_index.top(min(int(count or 10), 30), low_score, high_score)
+            if not records:
+                await app.send_group_message(group, "还没有")
+                return
+            lines = [f"{record.score} {os.path.relpath(record.path, store_dir_path)}" for record in records]
+            total = score_index.count(low_score, high_score)
+            await app.send_group_message(group, "\n".join(lines + [f"{len(records)}/{total}"]))
+
+        stats_keyword: str = self._config_registry.get_config(self.CONFIG_SCORE_STATS_KEYWORD)
+
+        @self.receiver(
+            GroupMessage,
+            decorators=[
+                ContainKeyword(keyword=stats_keyword),
+            ],
+            dispatchers=[CoolDown(5)],
+        )
+        async def score_stats(app: Ariadne, group: Group, message: MessageChain):
+            """
+            Replies with the number of pictures per level, the mean score and the best source dirs.
+            """
+            if str(message).strip() != stats_keyword:
+                return
+            levels = " ".join(f"L{score}:{count}" for score, count in score_index.level_counts().items())
+            dirs = sorted(
+                (mean, count, source_dir)
+                for source_dir, (count, mean) in score_index.dir_stats().items()
+                if source_dir is not None
+            )[::-1]
+            lines = [f"{len(score_index)} pics, mean {score_index.mean:.2f}", levels]
+            lines += [f"{mean:.2f} ({count}) {os.path.basename(source_dir)}" for mean, count, source_dir in dirs[:5]]
+            await app.send_group_message(group, "\n".join(line for line in lines if line))
+
+        cache_manager: CacheManager = CacheManager(
+            cache_dir=cache_dir_path,
+            max_bytes=self._config_registry.get_config(self.CONFIG_CACHE_MAX_SIZE),
+            max_files=self._config_registry.get_config(self.CONFIG_CACHE_MAX_FILES),
+            max_age=self._config_registry.get_config(self.CONFIG_CACHE_MAX_AGE) or None,
+            keep=["shards", "quality_hints.json"],
+            on_evict=compress_cache.forget,
+        )
+
+        def cache_protected() -> List[str]:
+            # taken on the event loop, the registry and the tallies are only changed there
+            return [record.path for record in img_registry.images_registry.values()] + aggregator.pending_paths()
+
+        @self.receiver(ApplicationLaunched)
+        async def cache_cleaner():
+            async def _clean_loop():
+                loop = asyncio.get_running_loop()
+                dropped, freed = await loop.run_in_executor(None, cache_manager.reconcile, cache_protected())
+                logger.info("cache reconciled, dropped %d files, %d bytes", dropped, freed)
+                interval: float = self._config_registry.get_config(self.CONFIG_CACHE_CLEAN_INTERVAL)
+                while True:
+                    await asyncio.sleep(interval)
+                    dropped, freed = await loop.run_in_executor(None, cache_manager.collect, cache_protected())
+                    if dropped:
+                        logger.info("cache collected, dropped %d files, %d bytes", dropped, freed)
+
+            asyncio.ensure_future(_clean_loop())
+
+        metrics.gauge("index_size", lambda: selector_ready.result().asset_size if selector_ready.done() else 0)
+        metrics.gauge("compress_pending", lambda: compressor.pending)
+        metrics.gauge("compress_cache_hits", lambda: compress_cache.hits)
+        metrics.gauge("compress_cache_misses", lambda: compress_cache.misses)
+        metrics.gauge("compress_cache_bytes", lambda: compress_cache.stats["bytes"])
+        metrics.gauge("cache_files", lambda: cache_manager.files)
+        metrics.gauge("cache_bytes", lambda: cache_manager.bytes)
+        metrics.gauge("votes_pending", lambda: len(aggregator))
+        metrics.gauge("scored_pictures", lambda: len(score_index))
+        metrics.gauge("warm_pool", lambda: pipeline.warm_count)
+        metrics_export_path: str = self._config_registry.get_config(self.CONFIG_METRICS_EXPORT_PATH)
+        if metrics_export_path:
+            metrics.add_exporter(JsonFileExporter(metrics_export_path))
+
+        @self.receiver(ApplicationLaunched)
+        async def metrics_exporter():
+            async def _export_loop():
+                interval: float = self._config_registry.get_config(self.CONFIG_METRICS_EXPORT_INTERVAL)
+                while True:
+                    await asyncio.sleep(interval)
+                    await asyncio.get_running_loop().run_in_executor(None, metrics.export)
+
+            asyncio.ensure_future(_export_loop())
+
+        @self.receiver(
+            GroupMessage,
+            decorators=[
+                ContainKeyword(keyword=self._config_registry.get_config(self.CONFIG_METRICS_KEYWORD)),
+            ],
+            dispatchers=[CoolDown(5)],
         )
-        return out_path
+        async def show_metrics(app: Ariadne, group: Group, message: MessageChain):
+            if str(message).strip() != self._config_registry.get_config(self.CONFIG_METRICS_KEYWORD):
+                return
+            await app.send_group_message(group, metrics.render() or "no metrics yet")
+
+        print(f"{Fore.CYAN}PicEval installed: {report(timings)}, index loading in background{Fore.RESET}")
+
+    def _get_selector(self) -> "Selector":
+        """
+        Returns the selector shared with `install`, building it on first use if the plugin is not installed.
+
+        While `install` still loads the index in the background, this waits for it.
+        """
+        if self._selector_ready is not None:
+            return self._selector_ready.result()
+        with self._shared_lock:
+            if self._selector is None:
+                from .select import Selector
+
+                Default.create_folders()
+                self._selector = Selector(
+                    asset_dirs=self.config_registry.get_config(self.CONFIG_PICTURE_ASSET_PATH),
+                    cache_dir=self.config_registry.get_config(self.CONFIG_PICTURE_CACHE_DIR_PATH),
+                    ignore_dirs=self.config_registry.get_config(self.CONFIG_PICTURE_IGNORED_DIRS),
+                    weights=self.config_registry.get_config(self.CONFIG_PICTURE_ASSET_WEIGHTS),
+                    workers=self.config_registry.get_config(self.CONFIG_INDEX_WORKERS),
+                )
+            return self._selector
+
+    def _get_compress_cache(self) -> "CompressCache":
+        """
+        Returns the compress cache shared with `install`, building it on first use if the plugin is not installed.
+        """
+        with self._shared_lock:
+            if self._compress_cache is None:
+                from .compress_cache import CompressCache
+
+                self._compress_cache = CompressCache(
+                    cache_dir=f"{self.config_registry.get_config(self.CONFIG_PICTURE_CACHE_DIR_PATH)}/compressed",
+                    max_bytes=self.config_registry.get_config(self.CONFIG_COMPRESS_CACHE_SIZE),
+                )
+            return self._compress_cache
+
+    def rand_pic(self, quality: int = 50) -> str:
+        """
+        Selects a random picture and compresses it.
+
+        Args:
+            quality (int, optional): The minimal quality of the compression. Defaults to 50.
+
+        Returns:
+            str: The path of the compressed picture, owned by the compress cache.
+        """
+        return self.rand_pics(1, quality)[0]
+
+    def rand_pics(self, count: int, quality: int = 50) -> List[str]:
+        """
+        Selects random pictures from the shared index and compresses them synchronously.
+
+        The outputs live in the compress cache, so a picture drawn again is not compressed twice. The returned
+        paths must not be deleted by the caller.
+
+        Args:
+            count (int): The number of pictures.
+            quality (int, optional): The minimal quality of the compression. Defaults to 50.
+
+        Returns:
+            List[str]: The paths of the compressed pictures.
+        """
+        selector = self._get_selector()
+        compress_cache = self._get_compress_cache()
+        max_file_size: int = self.config_registry.get_config(self.CONFIG_MAX_FILE_SIZE)
+
+        def _create(input_image_path: str, output_image_path: str):
+            compress_image_max_vol(
+                input_image_path=input_image_path,
+                output_image_path=output_image_path,
+                max_file_size=max_file_size,
+                search_best=False,
+                min_quality=quality,
+            )
+
+        return [
+            compress_cache.get_or_create(selector.random_select(), max_file_size, _create, min_quality=quality)
+            for _ in range(count)
+        ]
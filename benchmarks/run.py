@@ -0,0 +1,330 @@
+"""
+Benchmarks the index, selection, registry, evaluation and compression paths of the plugin on synthetic data.
+
+Usage:
+    python benchmarks/run.py [--sizes 10000,100000] [--only index,select] [--output results.json]
+
+The results are written as json, one record per measurement, together with the commit and the platform, so runs
+of different commits can be compared. Synthetic trees are cached in the work dir and reused across runs.
+"""
+import argparse
+import asyncio
+import contextlib
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import List, Dict, Any, Callable, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stubs import PACKAGE_ROOT, install_stubs, load_package  # noqa: E402
+
+FILES_PER_DIR = 1000
+DIRS_PER_PARENT = 100
+
+Result = Dict[str, Any]
+
+
+def tree_path(root: str, i: int) -> str:
+    leaf = i // FILES_PER_DIR
+    return os.path.join(root, f"p{leaf // DIRS_PER_PARENT:04d}", f"d{leaf:06d}", f"{i:08d}.jpg")
+
+
+def make_tree(root: str, count: int) -> None:
+    """
+    Creates a tree of ``count`` empty files, ``FILES_PER_DIR`` per leaf dir, or reuses the one left by a previous run.
+
+    The path of the i-th file is `tree_path`, so no path list is held in memory even for millions of files.
+    """
+    marker = f"{root}.complete"
+    if os.path.exists(marker):
+        return
+    shutil.rmtree(root, ignore_errors=True)
+    for start in range(0, count, FILES_PER_DIR):
+        os.makedirs(os.path.dirname(tree_path(root, start)), exist_ok=True)
+        for i in range(start, min(start + FILES_PER_DIR, count)):
+            open(tree_path(root, i), "wb").close()
+    open(marker, "wb").close()
+
+
+def make_images(root: str, sizes: List[Tuple[int, int]], per_size: int) -> List[str]:
+    """
+    Creates noisy gradient images of the given sizes, which compress about as badly as photos.
+    """
+    from PIL import Image
+
+    os.makedirs(root, exist_ok=True)
+    paths = []
+    for width, height in sizes:
+        for n in range(per_size):
+            path = os.path.join(root, f"{width}x{height}_{n}.png")
+            if not os.path.exists(path):
+                gradient = Image.linear_gradient("L").resize((width, height))
+                noise = Image.effect_noise((width, height), 64)
+                Image.merge("RGB", (gradient, noise, gradient.transpose(Image.FLIP_LEFT_RIGHT))).save(path)
+            paths.append(path)
+    return paths
+
+
+def timed(func: Callable[[], Any]) -> Tuple[float, Any]:
+    gc.collect()
+    start = time.perf_counter()
+    value = func()
+    return time.perf_counter() - start, value
+
+
+def traced(func: Callable[[], Any]) -> Tuple[int, int, Any]:
+    """
+    Runs a function under tracemalloc and returns the peak and the retained bytes of Python allocations.
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        value = func()
+        retained, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak, retained, value
+
+
+def bench_index(work_dir: str, sizes: List[int], memory: bool) -> List[Result]:
+    from pic_eval.file_index import FileIndex
+
+    results = []
+    for size in sizes:
+        root = os.path.join(work_dir, f"tree_{size}")
+        make_tree(root, size)
+
+        def build():
+            index = FileIndex([root], [])
+            index.refresh()
+            return index
+
+        build_seconds, index = timed(build)
+        result: Result = {"name": "index", "size": size, "build_seconds": build_seconds}
+        result["refresh_noop_seconds"], _ = timed(index.refresh)
+        index_path = os.path.join(work_dir, f"index_{size}.idx")
+        result["dump_seconds"], _ = timed(lambda: index.dump(index_path, key=b"bench"))
+        result["file_bytes"] = os.path.getsize(index_path)
+        del index
+        result["load_seconds"], loaded = timed(lambda: FileIndex.load(index_path, key=b"bench"))
+        draws = min(100000, size)
+        result["path_at_per_second"] = draws / timed(
+            lambda: [loaded.path_at(loaded.random_position()) for _ in range(draws)]
+        )[0]
+        del loaded
+        if memory:
+            result["build_peak_bytes"], result["build_retained_bytes"], _ = traced(build)
+            result["load_peak_bytes"], result["load_retained_bytes"], _ = traced(
+                lambda: FileIndex.load(index_path, key=b"bench")
+            )
+        results.append(result)
+    return results
+
+
+def bench_select(work_dir: str, sizes: List[int], draws: int, missing: float) -> List[Result]:
+    from pic_eval.select import Selector
+
+    results = []
+    for size in sizes:
+        root = os.path.join(work_dir, f"tree_{size}")
+        make_tree(root, size)
+        cache_dir = os.path.join(work_dir, f"select_cache_{size}")
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        result: Result = {"name": "select", "size": size, "draws": draws}
+        result["cold_start_seconds"], _ = timed(lambda: Selector([root], cache_dir))
+        result["warm_start_seconds"], selector = timed(lambda: Selector([root], cache_dir))
+        result["draws_per_second"] = draws / timed(lambda: [selector.random_select() for _ in range(draws)])[0]
+
+        removed = [tree_path(root, i) for i in random.sample(range(size), int(size * missing))]
+        for path in removed:
+            os.remove(path)
+        try:
+            result["missing_fraction"] = missing
+            result["missing_draws_per_second"] = (
+                draws / timed(lambda: [selector.random_select() for _ in range(draws)])[0]
+            )
+            result["entries_dropped"] = size - selector.asset_size
+        finally:
+            for path in removed:
+                open(path, "wb").close()
+        results.append(result)
+    return results
+
+
+def bench_registry(work_dir: str, sizes: List[int]) -> List[Result]:
+    from pic_eval.img_manager import ImageRegistry
+
+    results = []
+    for size in sizes:
+        save_path = os.path.join(work_dir, f"registry_{size}.db")
+        for path in (save_path, f"{save_path}.journal"):
+            if os.path.exists(path):
+                os.remove(path)
+        registry = ImageRegistry(save_path)
+        result: Result = {"name": "registry", "size": size}
+
+        def register():
+            for key in range(size):
+                registry.register(key, f"/assets/p{key // 1000:04d}/{key:08d}.jpg")
+
+        result["register_seconds"], _ = timed(register)
+        result["register_per_second"] = size / result["register_seconds"]
+        result["journal_bytes"] = os.path.getsize(f"{save_path}.journal")
+        registry.close()
+        result["load_journal_seconds"], registry = timed(lambda: ImageRegistry(save_path))
+        result["compact_seconds"], _ = timed(registry.save)
+        registry.close()
+        result["load_snapshot_seconds"], registry = timed(lambda: ImageRegistry(save_path, max_size=size // 2))
+        result["prune_half_seconds"], _ = timed(registry.prune)
+        registry.close()
+        results.append(result)
+    return results
+
+
+def bench_evaluate(work_dir: str, count: int) -> List[Result]:
+    from pic_eval.evaluate import Evaluate
+
+    store_dir = os.path.join(work_dir, "store")
+    staging_dir = os.path.join(work_dir, "staging")
+    shutil.rmtree(store_dir, ignore_errors=True)
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    os.makedirs(store_dir)
+    os.makedirs(staging_dir)
+    evaluator = Evaluate(store_dir_path=store_dir, level_resolution=10)
+    marks = []
+    for i in range(count):
+        path = os.path.join(staging_dir, f"{i:08d}.jpg")
+        open(path, "wb").close()
+        marks.append((path, random.randint(1, 10), f"/assets/{i}.jpg"))
+    seconds, _ = timed(lambda: evaluator.mark_many(marks))
+    scores_seconds, scores = timed(evaluator.scores)
+    return [
+        {
+            "name": "evaluate",
+            "size": count,
+            "mark_many_seconds": seconds,
+            "marks_per_second": count / seconds,
+            "scores_seconds": scores_seconds,
+            "scores": len(scores),
+        }
+    ]
+
+
+def bench_compress(work_dir: str, count: int, workers: int, max_file_size: int) -> List[Result]:
+    from pic_eval.compressor import ImageCompressor
+    from pic_eval.compress_cache import CompressCache
+
+    try:
+        images = make_images(os.path.join(work_dir, "images"), [(1024, 768), (3000, 2000)], max(1, count // 2))
+    except ImportError:
+        return [{"name": "compress", "skipped": "Pillow is not installed"}]
+    cache_dir = os.path.join(work_dir, "compressed")
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    compressor = ImageCompressor(
+        max_workers=workers, max_pending=len(images), cache=CompressCache(cache_dir, max_bytes=1 << 40)
+    )
+
+    async def run_all():
+        return await asyncio.gather(*(compressor.compress_cached(image, max_file_size) for image in images))
+
+    try:
+        compressor_seconds, _ = timed(lambda: asyncio.run(run_all()))
+        cached_seconds, _ = timed(lambda: asyncio.run(run_all()))
+    finally:
+        compressor.shutdown()
+    input_bytes = sum(os.path.getsize(image) for image in images)
+    output_bytes = sum(entry.stat().st_size for entry in os.scandir(cache_dir))
+    return [
+        {
+            "name": "compress",
+            "images": len(images),
+            "workers": workers,
+            "max_file_size": max_file_size,
+            "seconds": compressor_seconds,
+            "images_per_second": len(images) / compressor_seconds,
+            "cached_seconds": cached_seconds,
+            "input_bytes": input_bytes,
+            "output_bytes": output_bytes,
+        }
+    ]
+
+
+def metadata(stubbed: List[str]) -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=PACKAGE_ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "time": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "stubbed_modules": stubbed,
+    }
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="10000,100000", help="comma separated tree sizes, up to 5000000")
+    parser.add_argument("--registry-sizes", default="1000,10000,100000")
+    parser.add_argument("--only", default="index,select,registry,evaluate,compress")
+    parser.add_argument("--draws", type=int, default=10000, help="random_select calls per measurement")
+    parser.add_argument("--missing", type=float, default=0.1, help="fraction of files deleted for the missing path")
+    parser.add_argument("--marks", type=int, default=1000)
+    parser.add_argument("--images", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--max-file-size", type=int, default=512 * 1024)
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc passes")
+    parser.add_argument("--work-dir", default=os.path.join(tempfile.gettempdir(), "pic_eval_bench"))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="the json file to write, defaults to stdout")
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    if "fork" in multiprocessing.get_all_start_methods():
+        # the compression workers must inherit the stubbed modules
+        multiprocessing.set_start_method("fork", force=True)
+    os.makedirs(args.work_dir, exist_ok=True)
+    stubbed = install_stubs(os.path.join(args.work_dir, "pwd"))
+    load_package()
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    only = set(args.only.split(","))
+
+    results: List[Result] = []
+    # the plugin reports progress on stdout, which is reserved for the results
+    with contextlib.redirect_stdout(sys.stderr):
+        if "index" in only:
+            results += bench_index(args.work_dir, sizes, memory=not args.no_memory)
+        if "select" in only:
+            results += bench_select(args.work_dir, sizes, args.draws, args.missing)
+        if "registry" in only:
+            results += bench_registry(args.work_dir, [int(size) for size in args.registry_sizes.split(",")])
+        if "evaluate" in only:
+            results += bench_evaluate(args.work_dir, args.marks)
+        if "compress" in only:
+            results += bench_compress(args.work_dir, args.images, args.workers, args.max_file_size)
+
+    report = json.dumps({"meta": metadata(stubbed), "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,120 @@
+"""
+Offline stand-ins for the host bot, so the plugin can be imported and benchmarked without it.
+
+The stubs are only installed for the modules that can not be imported, so a checkout inside a working bot
+benchmarks the real helpers.
+"""
+import importlib.util
+import os
+import random
+import shutil
+import string
+import sys
+import types
+from typing import List, Sequence
+
+PACKAGE_NAME = "pic_eval"
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def explore_folder(root_path: str, ignore_list: Sequence[str] = ()) -> List[str]:
+    found = []
+    for dir_path, dir_names, file_names in os.walk(root_path):
+        dir_names[:] = [name for name in dir_names if name not in ignore_list]
+        found.extend(os.path.join(dir_path, name) for name in file_names)
+    return found
+
+
+def get_all_sub_dirs(path: str) -> List[str]:
+    return [entry.name for entry in os.scandir(path) if entry.is_dir()]
+
+
+def generate_random_string(length: int) -> str:
+    return "".join(random.choice(string.ascii_letters) for _ in range(length))
+
+
+def compress_image_max_vol(
+    input_image_path: str,
+    output_image_path: str,
+    max_file_size: int,
+    search_best: bool = True,
+    min_quality: int = 1,
+    quality_step: int = 5,
+) -> int:
+    """
+    Re-encodes an image as JPEG, lowering the quality until it fits, like the helper of the bot.
+
+    Without Pillow the image is copied as is and 100 is returned.
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        shutil.copyfile(input_image_path, output_image_path)
+        return 100
+    with Image.open(input_image_path) as img:
+        img = img.convert("RGB")
+        quality = 95
+        while True:
+            img.save(output_image_path, format="JPEG", quality=quality)
+            if os.path.getsize(output_image_path) <= max_file_size or quality - quality_step < min_quality:
+                return quality
+            quality -= quality_step
+
+
+def install_stubs(pwd: str) -> List[str]:
+    """
+    Registers the stub modules for every host module that is missing.
+
+    Args:
+        pwd (str): The working dir returned by the stubbed ``get_pwd``.
+
+    Returns:
+        List[str]: The names of the stubbed modules.
+    """
+    stubbed = []
+    try:
+        importlib.import_module("modules.shared")
+        importlib.import_module("modules.file_manager")
+        return stubbed
+    except ImportError:
+        pass
+
+    package = types.ModuleType("modules")
+    package.__path__ = []
+    file_manager = types.ModuleType("modules.file_manager")
+    file_manager.explore_folder = explore_folder
+    file_manager.get_all_sub_dirs = get_all_sub_dirs
+    shared = types.ModuleType("modules.shared")
+
+    class AbstractPlugin(object):
+        pass
+
+    async def download_file(url: str, save_dir: str) -> str:
+        raise RuntimeError("downloads are not available offline")
+
+    shared.get_pwd = lambda: pwd
+    shared.AbstractPlugin = AbstractPlugin
+    shared.explore_folder = explore_folder
+    shared.compress_image_max_vol = compress_image_max_vol
+    shared.generate_random_string = generate_random_string
+    shared.download_file = download_file
+    package.file_manager, package.shared = file_manager, shared
+    for module in (package, file_manager, shared):
+        sys.modules[module.__name__] = module
+        stubbed.append(module.__name__)
+    return stubbed
+
+
+def load_package() -> types.ModuleType:
+    """
+    Imports the plugin from this checkout under `PACKAGE_NAME`, whatever the name of the checkout dir.
+    """
+    if PACKAGE_NAME in sys.modules:
+        return sys.modules[PACKAGE_NAME]
+    spec = importlib.util.spec_from_file_location(
+        PACKAGE_NAME, os.path.join(PACKAGE_ROOT, "__init__.py"), submodule_search_locations=[PACKAGE_ROOT]
+    )
+    package = importlib.util.module_from_spec(spec)
+    sys.modules[PACKAGE_NAME] = package
+    spec.loader.exec_module(package)
+    return package
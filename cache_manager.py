@@ -0,0 +1,145 @@
+import os
+import threading
+import time
+from typing import List, Dict, Optional, Callable, Sequence, Collection, Tuple
+
+from .compress_cache import CompressCache
+from .metrics import metrics
+
+
+class CacheManager(object):
+    """
+    Keeps the cache dir within a byte and a file budget.
+
+    Every file below the cache dir is a cache entry, except the state kept there on purpose, such as the index
+    files, which are listed in ``keep``. A collection first drops the entries older than ``max_age``, then the
+    least recently used entries, judged by their mtime, until both budgets are met. Entries used in the last
+    ``grace`` seconds, which covers downloads and encodes in progress as well as outputs about to be sent, and the
+    paths passed as protected, such as the images still waiting for votes, are never dropped.
+
+    A collection walks the whole dir, so it is meant to run in a worker thread.
+    """
+
+    STALE_MARKS = (CompressCache.TEMP_MARK, ".tmp")
+
+    def __init__(
+        self,
+        cache_dir: str,
+        max_bytes: int = 1024 * 1024 * 1024,
+        max_files: int = 20000,
+        max_age: Optional[float] = None,
+        grace: float = 600.0,
+        keep: Sequence[str] = (),
+        on_evict: Optional[Callable[[str], None]] = None,
+    ):
+        """
+        Initializes the CacheManager.
+
+        Args:
+            cache_dir (str): The cache dir.
+            max_bytes (int, optional): The size budget in bytes. Defaults to 1 GiB.
+            max_files (int, optional): The file count budget. Defaults to 20000.
+            max_age (float, optional): The age in seconds past which an unused entry is dropped anyway.
+            grace (float, optional): The age in seconds under which an entry is never dropped. Defaults to 600.
+            keep (Sequence[str], optional): The files and dirs, relative to the cache dir, that are not cache entries.
+            on_evict (Callable[[str], None], optional): Called with the path of every dropped entry.
+        """
+        self._cache_dir: str = os.path.abspath(cache_dir)
+        self._max_bytes: int = max_bytes
+        self._max_files: int = max_files
+        self._max_age: Optional[float] = max_age
+        self._grace: float = grace
+        self._keep: List[str] = [os.path.join(self._cache_dir, path) for path in keep]
+        self._on_evict: Optional[Callable[[str], None]] = on_evict
+        self._lock = threading.Lock()
+        self.files: int = 0
+        self.bytes: int = 0
+
+    def _kept(self, path: str) -> bool:
+        return any(path == kept or path.startswith(os.path.join(kept, "")) for kept in self._keep)
+
+    def _scan(self) -> List[Tuple[float, int, str]]:
+        found = []
+        for dir_path, dir_names, file_names in os.walk(self._cache_dir):
+            dir_names[:] = [name for name in dir_names if not self._kept(os.path.join(dir_path, name))]
+            for name in file_names:
+                path = os.path.join(dir_path, name)
+                if self._kept(path):
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                found.append((stat.st_mtime, stat.st_size, path))
+        found.sort()
+        return found
+
+    def _drop(self, path: str) -> bool:
+        try:
+            os.remove(path)
+        except OSError:
+            return False
+        if self._on_evict:
+            self._on_evict(path)
+        return True
+
+    def reconcile(self, protected: Collection[str] = ()) -> Tuple[int, int]:
+        """
+        Cleans the cache dir at startup: removes the temporary files left by interrupted writes, then collects.
+
+        Args:
+            protected (Collection[str], optional): The paths that must not be dropped.
+
+        Returns:
+            Tuple[int, int]: The number of dropped files and the number of freed bytes.
+        """
+        deadline = time.time() - self._grace
+        dropped = freed = 0
+        for mtime, size, path in self._scan():
+            if mtime < deadline and any(mark in os.path.basename(path) for mark in self.STALE_MARKS):
+                if self._drop(path):
+                    dropped += 1
+                    freed += size
+        collected = self.collect(protected)
+        return dropped + collected[0], freed + collected[1]
+
+    def collect(self, protected: Collection[str] = ()) -> Tuple[int, int]:
+        """
+        Drops the expired entries, then the least recently used ones until the cache fits its budgets.
+
+        Args:
+            protected (Collection[str], optional): The paths that must not be dropped.
+
+        Returns:
+            Tuple[int, int]: The number of dropped files and the number of freed bytes.
+        """
+        with self._lock:
+            protected = {os.path.abspath(path) for path in protected if path}
+            entries = self._scan()
+            files, total = len(entries), sum(size for _, size, _ in entries)
+            now = time.time()
+            dropped = freed = 0
+            for mtime, size, path in entries:
+                expired = self._max_age is not None and mtime < now - self._max_age
+                if not expired and files <= self._max_files and total <= self._max_bytes:
+                    # the entries are sorted by mtime, none of the remaining ones has expired either
+                    break
+                if mtime >= now - self._grace or path in protected:
+                    continue
+                if self._drop(path):
+                    files -= 1
+                    total -= size
+                    dropped += 1
+                    freed += size
+            self.files, self.bytes = files, total
+        if dropped:
+            metrics.counter("cache_evicted_files").inc(dropped)
+            metrics.counter("cache_evicted_bytes").inc(freed)
+        return dropped, freed
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """
+        The number of files and bytes found by the last collection.
+        """
+        return {"files": self.files, "bytes": self.bytes}
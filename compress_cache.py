@@ -0,0 +1,174 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Callable
+from uuid import uuid4
+
+
+class CompressCache(object):
+    """
+    A content-addressed cache of compressed images.
+
+    An output is keyed by the absolute source path, the source mtime and size, and the compression parameters,
+    so a changed source or a changed ``MaxFileSize`` never hits a stale output. Entries are evicted least recently
+    used first once the cache grows beyond ``max_bytes``. The mtime of an output is bumped on every hit, which
+    keeps the LRU order across restarts.
+    """
+
+    TEMP_MARK = ".part-"
+
+    def __init__(self, cache_dir: str, max_bytes: int = 512 * 1024 * 1024):
+        """
+        Initializes the CompressCache and reconciles it with the content of the cache dir.
+
+        Args:
+            cache_dir (str): The directory to store the compressed outputs in.
+            max_bytes (int, optional): The size budget of the cache in bytes. Defaults to 512 MiB.
+        """
+        self._cache_dir: str = os.path.abspath(cache_dir)
+        os.makedirs(self._cache_dir, exist_ok=True)
+        self._max_bytes: int = max_bytes
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._total_bytes: int = 0
+        self._lock = threading.Lock()
+        self.hits: int = 0
+        self.misses: int = 0
+        self._reconcile()
+
+    def _reconcile(self) -> None:
+        found = []
+        with os.scandir(self._cache_dir) as it:
+            for entry in it:
+                if not entry.is_file():
+                    continue
+                if self.TEMP_MARK in entry.name:
+                    os.remove(entry.path)
+                    continue
+                stat = entry.stat()
+                found.append((stat.st_mtime_ns, entry.path, stat.st_size))
+        found.sort()
+        for _, path, size in found:
+            self._entries[path] = size
+            self._total_bytes += size
+        self._evict()
+
+    def path_for(self, source_path: str, max_file_size: int, ext: Optional[str] = None, **params: Any) -> str:
+        """
+        Returns the output path that caches the given source compressed with the given parameters.
+
+        Args:
+            source_path (str): The path of the source image.
+            max_file_size (int): The maximal size of the compressed output.
+            ext (str, optional): The extension of the output, such as ``".jpg"``. Defaults to the one of the source.
+            **params: The other parameters the output depends on, such as ``min_quality``.
+
+        Returns:
+            str: The path of the cached output, which may not exist yet.
+
+        Raises:
+            OSError: If the source can not be stat-ed.
+        """
+        source_path = os.path.abspath(source_path)
+        stat = os.stat(source_path)
+        key = "\0".join(
+            [source_path, str(stat.st_mtime_ns), str(stat.st_size), str(max_file_size), repr(sorted(params.items()))]
+        )
+        digest = hashlib.sha1(key.encode("utf-8", "surrogateescape")).hexdigest()
+        return os.path.join(self._cache_dir, f"{digest}{ext or os.path.splitext(source_path)[1]}")
+
+    def temp_path_for(self, output_path: str) -> str:
+        """
+        Returns a unique temporary path to write the output to before it is committed with `store`.
+        """
+        root, ext = os.path.splitext(output_path)
+        return f"{root}{self.TEMP_MARK}{uuid4().hex}{ext}"
+
+    def lookup(self, output_path: str) -> bool:
+        """
+        Checks whether the output is cached, and marks it as recently used if so.
+
+        Args:
+            output_path (str): The path returned by `path_for`.
+
+        Returns:
+            bool: True on a hit.
+        """
+        with self._lock:
+            if output_path in self._entries:
+                try:
+                    os.utime(output_path)
+                except OSError:
+                    self._total_bytes -= self._entries.pop(output_path)
+                else:
+                    self._entries.move_to_end(output_path)
+                    self.hits += 1
+                    return True
+            self.misses += 1
+            return False
+
+    def store(self, output_path: str, temp_path: Optional[str] = None) -> None:
+        """
+        Adds an output to the cache and evicts the least recently used outputs beyond the budget.
+
+        Args:
+            output_path (str): The path returned by `path_for`.
+            temp_path (str, optional): A path returned by `temp_path_for` that is moved to ``output_path`` first.
+        """
+        if temp_path is not None:
+            os.replace(temp_path, output_path)
+        size = os.path.getsize(output_path)
+        with self._lock:
+            self._total_bytes += size - self._entries.pop(output_path, 0)
+            self._entries[output_path] = size
+            self._evict()
+
+    def get_or_create(
+        self, source_path: str, max_file_size: int, create: Callable[[str, str], Any], **params: Any
+    ) -> str:
+        """
+        Returns the cached output of a source, creating it synchronously on a miss.
+
+        Args:
+            source_path (str): The path of the source image.
+            max_file_size (int): The maximal size of the compressed output.
+            create (Callable[[str, str], Any]): Writes the output of the source, called with both paths.
+            **params: The other parameters the output depends on, see `path_for`.
+
+        Returns:
+            str: The path of the cached output.
+        """
+        output_path = self.path_for(source_path, max_file_size, **params)
+        if self.lookup(output_path):
+            return output_path
+        temp_path = self.temp_path_for(output_path)
+        try:
+            create(source_path, temp_path)
+            self.store(output_path, temp_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return output_path
+
+    def forget(self, output_path: str) -> None:
+        """
+        Drops an output that was removed from the cache dir by someone else, such as the `CacheManager`.
+        """
+        with self._lock:
+            self._total_bytes -= self._entries.pop(os.path.abspath(output_path), 0)
+
+    def _evict(self) -> None:
+        while self._total_bytes > self._max_bytes and len(self._entries) > 1:
+            path, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """
+        The hit and miss counters together with the current size of the cache.
+        """
+        return {"hits": self.hits, "misses": self.misses, "files": len(self._entries), "bytes": self._total_bytes}
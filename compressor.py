@@ -0,0 +1,237 @@
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from typing import Optional, Any, Dict, Tuple
+
+from .compress_cache import CompressCache
+from .fast_compress import SENDABLE_EXTENSIONS, QualityHints, fast_compress
+from .metrics import metrics, SIZE_BOUNDS, QUALITY_BOUNDS
+
+
+class CompressorBusy(RuntimeError):
+    """
+    Raised when the compression queue is full and a new job is rejected.
+    """
+
+
+def _compress_job(input_image_path: str, output_image_path: str, max_file_size: int, **kwargs: Any) -> int:
+    from modules.shared import compress_image_max_vol
+
+    return compress_image_max_vol(input_image_path, output_image_path, max_file_size, **kwargs)
+
+
+def _fast_compress_job(
+    input_image_path: str, output_image_path: str, max_file_size: int, hint: Optional[Tuple[int, int]], **kwargs: Any
+) -> Tuple[int, int, int]:
+    try:
+        return fast_compress(
+            input_image_path, output_image_path, max_file_size, hint=hint, min_quality=kwargs.get("min_quality", 10)
+        )
+    except Exception:
+        # animated, undecodable by Pillow or too large even at the lowest quality
+        return _compress_job(input_image_path, output_image_path, max_file_size, search_best=False, **kwargs), 0, 1
+
+
+class ImageCompressor(object):
+    """
+    Runs `compress_image_max_vol` in a process pool so that encoding never blocks the event loop.
+
+    At most ``max_workers`` jobs run at the same time, the other accepted jobs wait for a free worker. Once
+    ``max_pending`` jobs are accepted, either running or waiting, new jobs are rejected with `CompressorBusy`.
+
+    With ``fast`` set, `compress_cached` serves sources already under the limit as they are and encodes the others
+    with `fast_compress`, which predicts the quality instead of searching it and reuses the `QualityHints` of
+    previous runs; `compress_image_max_vol` remains the fallback.
+    """
+
+    def __init__(
+        self,
+        max_workers: Optional[int] = None,
+        max_pending: int = 16,
+        cache: Optional[CompressCache] = None,
+        fast: bool = False,
+        hints: Optional[QualityHints] = None,
+    ):
+        """
+        Initializes the ImageCompressor. The process pool is created on first use.
+
+        Args:
+            max_workers (int, optional): The number of worker processes. Defaults to the cpu count minus one.
+            max_pending (int, optional): The maximal number of accepted jobs. Defaults to 16.
+            cache (CompressCache, optional): The cache used by `compress_cached`.
+            fast (bool, optional): Whether `compress_cached` takes the fast path. Defaults to False.
+            hints (QualityHints, optional): The quality hints of the fast path.
+        """
+        self._max_workers: int = max_workers or max(1, (os.cpu_count() or 2) - 1)
+        self._max_pending: int = max(max_pending, self._max_workers)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._pending: int = 0
+        self._cache: Optional[CompressCache] = cache
+        self._inflight: Dict[str, "asyncio.Future[str]"] = {}
+        self._fast: bool = fast
+        self._hints: Optional[QualityHints] = hints
+
+    @property
+    def pending(self) -> int:
+        """
+        The number of accepted jobs that did not finish yet.
+        """
+        return self._pending
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self._max_workers)
+        return self._executor
+
+    async def compress(
+        self,
+        input_image_path: str,
+        output_image_path: str,
+        max_file_size: int,
+        search_best: bool = False,
+        **kwargs: Any,
+    ) -> int:
+        """
+        Compresses an image in the process pool.
+
+        Args:
+            input_image_path (str): The path of the source image.
+            output_image_path (str): The path to write the compressed image to.
+            max_file_size (int): The maximal size of the output in bytes.
+            search_best (bool, optional): Whether to search the best quality. Defaults to False.
+            **kwargs: Extra keyword arguments passed to `compress_image_max_vol`, such as ``min_quality``.
+
+        Returns:
+            int: The quality the image was compressed with.
+
+        Raises:
+            CompressorBusy: If too many jobs are already pending.
+        """
+        job = partial(
+            _compress_job, input_image_path, output_image_path, max_file_size, search_best=search_best, **kwargs
+        )
+        quality = await self._run(job)
+        self._observe(input_image_path, output_image_path, quality)
+        return quality
+
+    async def _run(self, job: partial) -> Any:
+        if self._pending >= self._max_pending:
+            raise CompressorBusy(f"{self._pending} compress jobs pending")
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self._max_workers)
+        self._pending += 1
+        try:
+            with metrics.timer("compress_wait_seconds"):
+                await self._slots.acquire()
+            try:
+                with metrics.timer("compress_seconds"):
+                    return await asyncio.get_running_loop().run_in_executor(self._get_executor(), job)
+            except BrokenProcessPool:
+                self._executor = None
+                raise
+            finally:
+                self._slots.release()
+        finally:
+            self._pending -= 1
+
+    @staticmethod
+    def _observe(input_image_path: str, output_image_path: str, quality: Optional[int]) -> None:
+        metrics.histogram("compress_bytes_in", SIZE_BOUNDS).observe(os.path.getsize(input_image_path))
+        metrics.histogram("compress_bytes_out", SIZE_BOUNDS).observe(os.path.getsize(output_image_path))
+        if quality is not None:
+            metrics.histogram("compress_quality", QUALITY_BOUNDS).observe(quality)
+
+    async def compress_fast(
+        self, input_image_path: str, output_image_path: str, max_file_size: int, **kwargs: Any
+    ) -> int:
+        """
+        Compresses an image in the process pool with `fast_compress`, starting from the hint of the source.
+
+        Args:
+            input_image_path (str): The path of the source image.
+            output_image_path (str): The path to write the compressed image to.
+            max_file_size (int): The maximal size of the output in bytes.
+            **kwargs: Extra keyword arguments passed to `compress_image_max_vol` when it is fallen back to.
+
+        Returns:
+            int: The quality the image was compressed with.
+
+        Raises:
+            CompressorBusy: If too many jobs are already pending.
+        """
+        hint = self._hints.get(input_image_path, max_file_size) if self._hints is not None else None
+        job = partial(_fast_compress_job, input_image_path, output_image_path, max_file_size, hint, **kwargs)
+        quality, passes, scale = await self._run(job)
+        self._observe(input_image_path, output_image_path, quality)
+        metrics.histogram("compress_passes", (0, 1, 2, 3)).observe(passes)
+        if passes and self._hints is not None and hint != (quality, scale):
+            self._hints.put(input_image_path, max_file_size, quality, scale)
+        return quality
+
+    async def compress_cached(self, input_image_path: str, max_file_size: int, **kwargs: Any) -> str:
+        """
+        Compresses an image through the cache, reusing a previous output of the same source and parameters.
+
+        Concurrent requests for the same output share a single compression job. On the fast path a source that
+        already fits is returned itself, so the result must never be deleted by the caller.
+
+        Args:
+            input_image_path (str): The path of the source image.
+            max_file_size (int): The maximal size of the output in bytes.
+            **kwargs: Extra keyword arguments passed to `compress`.
+
+        Returns:
+            str: The path of the compressed output.
+
+        Raises:
+            CompressorBusy: If the output is not cached and too many jobs are already pending.
+            ValueError: If the compressor was created without a cache.
+        """
+        if self._cache is None:
+            raise ValueError("compressor has no cache")
+        if (
+            self._fast
+            and input_image_path.lower().endswith(SENDABLE_EXTENSIONS)
+            and os.path.getsize(input_image_path) <= max_file_size
+        ):
+            metrics.counter("compress_zero_copy").inc()
+            return input_image_path
+        if self._fast:
+            # `fast_compress` always writes JPEG, whatever the format of the source
+            output_path = self._cache.path_for(input_image_path, max_file_size, ext=".jpg", encoder="fast", **kwargs)
+        else:
+            output_path = self._cache.path_for(input_image_path, max_file_size, encoder="slow", **kwargs)
+        inflight = self._inflight.get(output_path)
+        if inflight is None:
+            if self._cache.lookup(output_path):
+                return output_path
+            inflight = asyncio.ensure_future(self._fill(input_image_path, output_path, max_file_size, **kwargs))
+            self._inflight[output_path] = inflight
+            inflight.add_done_callback(lambda _: self._inflight.pop(output_path, None))
+        return await asyncio.shield(inflight)
+
+    async def _fill(self, input_image_path: str, output_path: str, max_file_size: int, **kwargs: Any) -> str:
+        temp_path = self._cache.temp_path_for(output_path)
+        try:
+            if self._fast:
+                await self.compress_fast(input_image_path, temp_path, max_file_size, **kwargs)
+            else:
+                await self.compress(input_image_path, temp_path, max_file_size, **kwargs)
+            self._cache.store(output_path, temp_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return output_path
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        Shuts the process pool down. A later job creates a new pool.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+        if self._hints is not None:
+            self._hints.save()
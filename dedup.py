@@ -0,0 +1,416 @@
+import os
+import struct
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, Dict, Optional, Sequence, Tuple, Callable, Set
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp")
+
+
+def dhash(image_path: str, hash_size: int = 8) -> int:
+    """
+    Computes the difference hash of an image.
+
+    The image is decoded at reduced resolution where the format allows it, shrunk to ``hash_size + 1`` by
+    ``hash_size`` grey pixels, and every bit tells whether a pixel is brighter than its right neighbour.
+
+    Args:
+        image_path (str): The path of the image.
+        hash_size (int, optional): The side of the hash, the hash has ``hash_size ** 2`` bits. Defaults to 8.
+
+    Returns:
+        int: The hash.
+    """
+    from PIL import Image
+
+    with Image.open(image_path) as img:
+        img.draft("L", (hash_size * 16, hash_size * 16))
+        pixels = list(img.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR).getdata())
+    bits = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            bits = (bits << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return bits
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def _hash_batch(paths: List[str]) -> List[Tuple[str, Optional[int]]]:
+    results = []
+    for path in paths:
+        try:
+            results.append((path, dhash(path)))
+        except Exception:
+            results.append((path, None))
+    return results
+
+
+def near_values(values: Sequence[int], radius: int) -> Dict[int, List[int]]:
+    """
+    Finds, for every hash, the other hashes within the radius, in bulk.
+
+    The hashes are split into ``radius // 2 + 1`` bit segments. Two hashes within the radius differ in at most one
+    bit of at least one segment, so every hash is only compared to the hashes whose segment equals its own, or
+    differs from it in one bit, which is far cheaper than a tree query per hash.
+
+    Args:
+        values (Sequence[int]): The distinct hashes.
+        radius (int): The maximal Hamming distance.
+
+    Returns:
+        Dict[int, List[int]]: The hashes within the radius of each hash that has any.
+    """
+    bits = max((value.bit_length() for value in values), default=0) or 1
+    width = -(-bits // (radius // 2 + 1))
+    mask = (1 << width) - 1
+    flips = [1 << bit for bit in range(width)]
+    near: Dict[int, Set[int]] = {}
+
+    def compare(bucket: List[int], others: List[int]) -> None:
+        for value in bucket:
+            for other in others:
+                if other != value and bin(value ^ other).count("1") <= radius:
+                    near.setdefault(value, set()).add(other)
+                    near.setdefault(other, set()).add(value)
+
+    for shift in range(0, bits, width):
+        buckets: Dict[int, List[int]] = {}
+        for value in values:
+            buckets.setdefault((value >> shift) & mask, []).append(value)
+        for key, bucket in buckets.items():
+            if len(bucket) > 1:
+                compare(bucket, bucket)
+            # every pair of segments one bit apart is visited once, from the smaller one
+            for flip in flips:
+                if key & flip:
+                    continue
+                others = buckets.get(key | flip)
+                if others:
+                    compare(bucket, others)
+    return {value: list(others) for value, others in near.items()}
+
+
+class BKTree(object):
+    """
+    A Burkhard-Keller tree over hashes under the Hamming distance.
+
+    A node is a list ``[hash, paths, children]`` where children maps the distance to the child's hash. A radius
+    query only descends into the children whose distance lies within the radius of the query's distance.
+    """
+
+    def __init__(self):
+        self._root: Optional[list] = None
+        self._size: int = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, value: int, path: str) -> None:
+        self._size += 1
+        if self._root is None:
+            self._root = [value, [path], {}]
+            return
+        node = self._root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(path)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [path], {}]
+                return
+            node = child
+
+    def discard(self, value: int, path: str) -> None:
+        node = self._root
+        while node is not None:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                if path in node[1]:
+                    node[1].remove(path)
+                    self._size -= 1
+                return
+            node = node[2].get(distance)
+
+    def search(self, value: int, radius: int) -> List[Tuple[int, str]]:
+        """
+        Returns every path whose hash lies within the radius, with its distance.
+        """
+        found: List[Tuple[int, str]] = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= radius:
+                found.extend((distance, path) for path in node[1])
+            for child_distance, child in node[2].items():
+                if distance - radius <= child_distance <= distance + radius:
+                    stack.append(child)
+        return found
+
+
+class PHashIndex(object):
+    """
+    A persistent perceptual-hash index of the images below a set of roots.
+
+    `update` only hashes the files that are new or whose mtime or size changed, in a process pool, and saves
+    progress regularly so an interrupted build resumes where it stopped. Lookups go through a `BKTree`.
+
+    The redundant images, see `is_redundant`, are computed in bulk at the end of `update` and kept up to date by
+    `add` and `discard`, so checking a drawn image is a set lookup.
+    """
+
+    _RECORD = struct.Struct("<qqQ?I")
+    MAGIC = b"PEPHASH\x01"
+
+    def __init__(
+        self,
+        save_path: str,
+        roots: Sequence[str],
+        radius: int = 4,
+        workers: Optional[int] = None,
+        within: Optional[Sequence[str]] = None,
+    ):
+        """
+        Initializes the PHashIndex and loads the hashes saved by a previous run.
+
+        Args:
+            save_path (str): The path the hashes are persisted to.
+            roots (Sequence[str]): The dirs to index.
+            radius (int, optional): The Hamming distance up to which two images count as duplicates. Defaults to 4.
+            workers (int, optional): The number of hashing processes. Defaults to the cpu count minus one.
+            within (Sequence[str], optional): Only near-duplicates below these dirs make an image redundant.
+                Defaults to the roots.
+        """
+        self._save_path: str = save_path
+        self._roots: List[str] = list(roots)
+        self._radius: int = radius
+        self._workers: int = workers or max(1, (os.cpu_count() or 2) - 1)
+        self._within: Tuple[str, ...] = tuple(os.path.join(root, "") for root in (within or roots))
+        self._entries: Dict[str, Tuple[int, int, Optional[int]]] = {}
+        self._tree: BKTree = BKTree()
+        self._redundant: Set[str] = set()
+        self._touched: Optional[List[str]] = None
+        self._lock = threading.Lock()
+        if os.path.exists(self._save_path):
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self._tree)
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        found: Dict[str, Tuple[int, int]] = {}
+        for root in self._roots:
+            for dir_path, _, file_names in os.walk(root):
+                for file_name in file_names:
+                    if not file_name.lower().endswith(IMAGE_EXTENSIONS):
+                        continue
+                    path = os.path.join(dir_path, file_name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    found[path] = (stat.st_mtime_ns, stat.st_size)
+        return found
+
+    def update(
+        self, batch_size: int = 256, save_every: int = 4096, progress: Optional[Callable[[int, int], None]] = None
+    ) -> Tuple[int, int]:
+        """
+        Brings the index up to date with the roots.
+
+        Args:
+            batch_size (int, optional): The number of files a worker hashes per job. Defaults to 256.
+            save_every (int, optional): The number of new hashes after which the index is saved. Defaults to 4096.
+            progress (Callable[[int, int], None], optional): Called with the hashed and total count of new files.
+
+        Returns:
+            Tuple[int, int]: The number of hashed and dropped files.
+        """
+        found = self._scan()
+        with self._lock:
+            dropped = [path for path in self._entries if path not in found]
+            for path in dropped:
+                self._forget(path)
+        todo = [path for path, stat in found.items() if self._entries.get(path, (None, None))[:2] != stat]
+        hashed = 0
+        if todo:
+            with ProcessPoolExecutor(max_workers=self._workers) as executor:
+                jobs = [executor.submit(_hash_batch, todo[i : i + batch_size]) for i in range(0, len(todo), batch_size)]
+                unsaved = 0
+                for job in as_completed(jobs):
+                    results = job.result()
+                    with self._lock:
+                        for path, value in results:
+                            self._forget(path)
+                            self._insert(path, found[path][0], found[path][1], value)
+                    hashed += len(results)
+                    unsaved += len(results)
+                    if progress:
+                        progress(hashed, len(todo))
+                    if unsaved >= save_every:
+                        self.save()
+                        unsaved = 0
+        if todo or dropped:
+            self.save()
+        self._refresh_redundant()
+        return hashed, len(dropped)
+
+    def _refresh_redundant(self) -> None:
+        with self._lock:
+            entries = dict(self._entries)
+            self._touched = []
+        redundant = self._find_redundant(entries)
+        with self._lock:
+            self._redundant = redundant
+            # the images added or discarded meanwhile are checked one by one
+            self._check_redundant(self._touched)
+            self._touched = None
+
+    def _find_redundant(self, entries: Dict[str, Tuple[int, int, Optional[int]]]) -> Set[str]:
+        by_value: Dict[int, List[str]] = {}
+        for path, (_, _, value) in entries.items():
+            if value is not None:
+                by_value.setdefault(value, []).append(path)
+        # the smallest path below ``within`` of every hash, which every image of a near hash defers to
+        preferred = {}
+        for value, paths in by_value.items():
+            candidates = [path for path in paths if path.startswith(self._within)]
+            if candidates:
+                preferred[value] = min(candidates)
+        near = near_values(list(by_value), self._radius)
+        redundant: Set[str] = set()
+        for value, paths in by_value.items():
+            found = [preferred[other] for other in near.get(value, []) + [value] if other in preferred]
+            if found:
+                best = min(found)
+                redundant.update(path for path in paths if best < path)
+        return redundant
+
+    def _check_redundant(self, paths: Sequence[str]) -> None:
+        for path in paths:
+            entry = self._entries.get(path)
+            if entry is None or entry[2] is None:
+                self._redundant.discard(path)
+                continue
+            found = self._tree.search(entry[2], self._radius)
+            if any(other < path and other.startswith(self._within) for _, other in found):
+                self._redundant.add(path)
+            else:
+                self._redundant.discard(path)
+
+    def _insert(self, path: str, mtime_ns: int, size: int, value: Optional[int]) -> None:
+        self._entries[path] = (mtime_ns, size, value)
+        if value is not None:
+            self._tree.add(value, path)
+
+    def _forget(self, path: str) -> None:
+        entry = self._entries.pop(path, None)
+        if entry is not None and entry[2] is not None:
+            self._tree.discard(entry[2], path)
+
+    def add(self, path: str, value: Optional[int] = None) -> Optional[int]:
+        """
+        Hashes a single file, if its hash is not given, and adds it to the index.
+
+        Returns:
+            Optional[int]: The hash, or None if the file can not be decoded.
+        """
+        if value is None:
+            value = _hash_batch([path])[0][1]
+        stat = os.stat(path)
+        with self._lock:
+            affected = self._neighbours(path)
+            self._forget(path)
+            self._insert(path, stat.st_mtime_ns, stat.st_size, value)
+            affected.extend(self._neighbours(path))
+            self._check_redundant(affected)
+            if self._touched is not None:
+                self._touched.extend(affected)
+        return value
+
+    def discard(self, path: str) -> None:
+        with self._lock:
+            affected = self._neighbours(path)
+            self._forget(path)
+            self._check_redundant(affected)
+            if self._touched is not None:
+                self._touched.extend(affected)
+
+    def _neighbours(self, path: str) -> List[str]:
+        entry = self._entries.get(path)
+        if entry is None or entry[2] is None:
+            return [path]
+        return [other for _, other in self._tree.search(entry[2], self._radius)] + [path]
+
+    def hash_of(self, path: str) -> Optional[int]:
+        """
+        Returns the hash of an indexed file, hashing the file if it is not indexed.
+        """
+        entry = self._entries.get(path)
+        if entry is not None:
+            return entry[2]
+        return _hash_batch([path])[0][1]
+
+    def duplicates(
+        self, path: str, value: Optional[int] = None, within: Optional[Sequence[str]] = None
+    ) -> List[Tuple[int, str]]:
+        """
+        Finds the near-duplicates of an image.
+
+        Args:
+            path (str): The path of the image, which is never reported as its own duplicate.
+            value (int, optional): The hash of the image, looked up or computed if not given.
+            within (Sequence[str], optional): Only report duplicates below these dirs.
+
+        Returns:
+            List[Tuple[int, str]]: The distances and paths of the duplicates, closest first.
+        """
+        value = self.hash_of(path) if value is None else value
+        if value is None:
+            return []
+        with self._lock:
+            found = self._tree.search(value, self._radius)
+        if within is not None:
+            prefixes = tuple(os.path.join(root, "") for root in within)
+            found = [item for item in found if item[1].startswith(prefixes)]
+        return sorted(item for item in found if item[1] != path)
+
+    def is_redundant(self, path: str) -> bool:
+        """
+        Tells whether an image has a near-duplicate below ``within`` that is preferred over it.
+
+        Of a group of near-duplicates only the one with the smallest path is not redundant, which keeps one
+        representative of every group selectable. Images are only known to be redundant once `update` finished.
+        """
+        return path in self._redundant
+
+    def save(self) -> None:
+        temp_path = f"{self._save_path}.tmp"
+        with self._lock:
+            items = list(self._entries.items())
+        with open(temp_path, "wb") as f:
+            f.write(self.MAGIC)
+            for path, (mtime_ns, size, value) in items:
+                encoded = path.encode("utf-8", "surrogateescape")
+                f.write(self._RECORD.pack(mtime_ns, size, value or 0, value is not None, len(encoded)) + encoded)
+        os.replace(temp_path, self._save_path)
+
+    def load(self) -> None:
+        with open(self._save_path, "rb") as f:
+            data = f.read()
+        if not data.startswith(self.MAGIC):
+            return
+        record_size = self._RECORD.size
+        offset = len(self.MAGIC)
+        with self._lock:
+            while offset + record_size <= len(data):
+                mtime_ns, size, value, valid, path_len = self._RECORD.unpack_from(data, offset)
+                offset += record_size
+                path = data[offset : offset + path_len].decode("utf-8", "surrogateescape")
+                offset += path_len
+                self._insert(path, mtime_ns, size, value if valid else None)
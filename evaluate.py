@@ -1,13 +1,23 @@
+import json
 import os
 import shutil
-from typing import List, Tuple
+import statistics
+import time
+from array import array
+from collections import OrderedDict
+from typing import List, Tuple, Dict, Optional, Iterable
 
 from modules.file_manager import get_all_sub_dirs
 
+from .metrics import metrics
+from .migration import read_resolution, write_resolution, RESOLUTION_MARKER
+from .score_index import ScoreIndex
+
 
 class Evaluate(object):
     LEVEL_PREFIX = "level"
     LEVEL_SUFFIX = ""
+    SCORE_LEDGER = "scores.jsonl"
 
     def __init__(self, store_dir_path: str, level_resolution: int):
         if level_resolution < 1 or level_resolution > 100:
@@ -15,32 +25,352 @@ class Evaluate(object):
         self._level_dirs: List[str] = [
             f"{self.LEVEL_PREFIX}{level}{self.LEVEL_SUFFIX}" for level in list(range(1, level_resolution + 1))
         ]
+        stored_resolution = read_resolution(store_dir_path)
+        if stored_resolution not in (None, level_resolution):
+            raise FileExistsError(
+                f"store dir is leveled for resolution {stored_resolution}, migrate it to {level_resolution} first"
+            )
         sub_dirs: List[str] = get_all_sub_dirs(store_dir_path)
         if any(sub_dir not in self._level_dirs for sub_dir in sub_dirs):
             raise FileExistsError("store dir have incorrect content!")
         for level_dir in self._level_dirs:
             os.makedirs(f"{store_dir_path}/{level_dir}", exist_ok=True)
+        if stored_resolution is None or not os.path.exists(f"{store_dir_path}/{RESOLUTION_MARKER}"):
+            write_resolution(store_dir_path, level_resolution)
         self._store_dir_path: str = store_dir_path
+        self._ledger_path: str = f"{store_dir_path}/{self.SCORE_LEDGER}"
+        self._score_index: ScoreIndex = ScoreIndex(self._ledger_path, store_dir_path, self._level_dirs)
 
         self._score_bound: Tuple[int, int] = (1, level_resolution)
 
-    def mark(self, file_path: str, score: int):
+    @property
+    def score_bound(self) -> Tuple[int, int]:
+        return self._score_bound
+
+    def mark(self, file_path: str, score: int, source: Optional[str] = None) -> str:
         """
         Moves a file to a target directory based on its score.
 
+        A file whose name is already taken in the target directory gets a numbered suffix. Every mark is recorded
+        in the `score_index`, which appends it to the score ledger of the store. A file of the store is moved to
+        the level of its new score.
+
         Parameters:
             file_path (str): The path of the file to be moved.
             score (int): The score of the file.
+            source (str, optional): The asset the file is a copy of, if known.
 
         Returns:
-            None
+            str: The path the file was moved to.
 
         Raises:
             ValueError: If the score is not within the specified bounds.
         """
         if self._score_bound[0] <= score <= self._score_bound[1]:
-            target_dir = f"{self._store_dir_path}/{self._level_dirs[score - 1]}"
-            os.makedirs(target_dir, exist_ok=True)
-            shutil.move(file_path, target_dir)
-            return
+            with metrics.timer("mark_seconds"):
+                target_dir = f"{self._store_dir_path}/{self._level_dirs[score - 1]}"
+                if os.path.dirname(file_path) == target_dir:
+                    self._score_index.add(file_path, score, source)
+                    return file_path
+                os.makedirs(target_dir, exist_ok=True)
+                stem, ext = os.path.splitext(os.path.basename(file_path))
+                target_path = f"{target_dir}/{stem}{ext}"
+                suffix = 0
+                while os.path.exists(target_path):
+                    suffix += 1
+                    target_path = f"{target_dir}/{stem}_{suffix}{ext}"
+                shutil.move(file_path, target_path)
+                self._score_index.add(target_path, score, source)
+                # a file of the store that is marked again leaves its previous record behind
+                self._score_index.discard(file_path)
+            return target_path
         raise ValueError("bad score")
+
+    def mark_many(self, marks: Iterable[Tuple[str, int, Optional[str]]]) -> List[str]:
+        """
+        Moves a batch of files to their target directories, skipping the files that vanished.
+
+        Parameters:
+            marks (Iterable[Tuple[str, int, Optional[str]]]): The paths of the files, their scores and sources.
+
+        Returns:
+            List[str]: The paths the files were moved to.
+        """
+        moved = []
+        for file_path, score, source in marks:
+            if os.path.exists(file_path):
+                moved.append(self.mark(file_path, score, source))
+        return moved
+
+    @property
+    def score_index(self) -> ScoreIndex:
+        return self._score_index
+
+    def scores(self) -> Dict[str, int]:
+        """
+        Returns the latest score of every asset that was marked with a known source, see `ScoreIndex`.
+
+        Returns:
+            Dict[str, int]: The scores by asset path.
+        """
+        return self._score_index.source_scores()
+
+
+class VoteTally(object):
+    """
+    The votes cast on one image, one score per voter.
+
+    Once the image is marked, ``path`` is its path in the store and ``score`` the score it was marked with.
+    """
+
+    __slots__ = ("path", "source", "opened_at", "voters", "scores", "score", "settled_at")
+
+    def __init__(self, path: str, opened_at: float, source: Optional[str] = None):
+        self.path: str = path
+        self.source: Optional[str] = source
+        self.opened_at: float = opened_at
+        self.voters: array = array("q")
+        self.scores: array = array("B")
+        self.score: Optional[int] = None
+        self.settled_at: Optional[float] = None
+
+    @property
+    def count(self) -> int:
+        return len(self.scores)
+
+    @property
+    def total(self) -> int:
+        return sum(self.scores)
+
+    def cast(self, voter: int, score: int) -> None:
+        """
+        Records a vote, replacing an earlier vote of the same voter.
+        """
+        for i, cast_voter in enumerate(self.voters):
+            if cast_voter == voter:
+                self.scores[i] = score
+                return
+        self.voters.append(voter)
+        self.scores.append(score)
+
+
+class VoteAggregator(object):
+    """
+    Collects the votes on images and marks an image only once its votes settle.
+
+    An image settles when ``quorum`` distinct voters scored it, or when ``settle_seconds`` passed since its
+    first vote. Settled images are then marked in one batch with the aggregated score. The pending tallies are
+    persisted to ``save_path`` so that a restart does not lose them; a settled tally stays persisted until
+    `settle` confirms that its image was marked.
+
+    A marked image is remembered for ``keep_seconds``. Votes cast on it meanwhile, or while it is being marked,
+    join its tally, and the image is marked again, moving it to another level, if they change its score.
+    """
+
+    AGGREGATES = ("mean", "median", "trimmed")
+
+    def __init__(
+        self,
+        save_path: str,
+        score_bound: Tuple[int, int],
+        quorum: int = 3,
+        settle_seconds: float = 600.0,
+        aggregate: str = "mean",
+        trim: float = 0.2,
+        keep_seconds: float = 24 * 3600.0,
+    ):
+        """
+        Initializes the VoteAggregator and loads the pending tallies.
+
+        Args:
+            save_path (str): The json file the pending tallies are persisted to.
+            score_bound (Tuple[int, int]): The inclusive bounds of a valid score.
+            quorum (int, optional): The number of voters that settles an image. Defaults to 3.
+            settle_seconds (float, optional): The time after the first vote that settles an image. Defaults to 600.
+            aggregate (str, optional): One of "mean", "median" or "trimmed". Defaults to "mean".
+            trim (float, optional): The fraction cut off both ends by the "trimmed" aggregate. Defaults to 0.2.
+            keep_seconds (float, optional): The time a marked image still takes votes. Defaults to a day.
+
+        Raises:
+            ValueError: If the aggregate is unknown.
+        """
+        if aggregate not in self.AGGREGATES:
+            raise ValueError(f"unknown aggregate {aggregate}, expected one of {self.AGGREGATES}")
+        self._save_path: str = save_path
+        self._score_bound: Tuple[int, int] = score_bound
+        self._quorum: int = max(1, quorum)
+        self._settle_seconds: float = settle_seconds
+        self._aggregate: str = aggregate
+        self._trim: float = trim
+        self._tallies: Dict[int, VoteTally] = {}
+        self._settling: Dict[int, VoteTally] = {}
+        self._keep_seconds: float = keep_seconds
+        self._settled: "OrderedDict[int, VoteTally]" = OrderedDict()
+        if os.path.exists(self._save_path):
+            self.load()
+
+    @property
+    def settle_seconds(self) -> float:
+        return self._settle_seconds
+
+    def __contains__(self, key: int) -> bool:
+        return key in self._tallies or key in self._settling or key in self._settled
+
+    def _tally(self, key: int) -> Optional[VoteTally]:
+        return self._tallies.get(key) or self._settling.get(key) or self._settled.get(key)
+
+    def __len__(self) -> int:
+        return len(self._tallies)
+
+    def pending_paths(self) -> List[str]:
+        """
+        Returns the paths of the images that are still waiting for their votes to settle.
+        """
+        return [tally.path for tally in self._tallies.values()] + [tally.path for tally in self._settling.values()]
+
+    def vote(
+        self, key: int, voter: int, score: int, path: Optional[str] = None, source: Optional[str] = None
+    ) -> VoteTally:
+        """
+        Casts a vote on an image, joining the tally of an image that is being marked or was marked recently.
+
+        Args:
+            key (int): The key of the image, usually the id of the message that carried it.
+            voter (int): The id of the voter.
+            score (int): The score.
+            path (str, optional): The local path of the image, required for the first vote on the image.
+            source (str, optional): The asset the image was sent from, if it was sent by the bot.
+
+        Returns:
+            VoteTally: The tally of the image after the vote.
+
+        Raises:
+            ValueError: If the score is out of bounds, or if the path is missing on the first vote.
+        """
+        if not self._score_bound[0] <= score <= self._score_bound[1]:
+            raise ValueError("bad score")
+        tally = self._tally(key)
+        if tally is None:
+            if path is None:
+                raise ValueError("the first vote on an image needs its path")
+            tally = self._tallies[key] = VoteTally(path, time.time(), source)
+        tally.cast(voter, score)
+        self.save()
+        return tally
+
+    def is_settled(self, tally: VoteTally, now: Optional[float] = None) -> bool:
+        now = time.time() if now is None else now
+        return tally.count >= self._quorum or now - tally.opened_at >= self._settle_seconds
+
+    def aggregate(self, tally: VoteTally) -> int:
+        """
+        Aggregates the votes of a tally into a single score within the score bounds.
+        """
+        scores = sorted(tally.scores)
+        if self._aggregate == "median":
+            value = statistics.median(scores)
+        elif self._aggregate == "trimmed":
+            cut = int(len(scores) * self._trim)
+            value = statistics.mean(scores[cut : len(scores) - cut] or scores)
+        else:
+            value = tally.total / tally.count
+        return min(max(int(round(value)), self._score_bound[0]), self._score_bound[1])
+
+    def pop_settled(self, force: bool = False) -> Dict[int, Tuple[str, int, Optional[str]]]:
+        """
+        Takes the settled tallies out of the pending ones and returns their images with the aggregated scores.
+
+        Marked images whose score changed with later votes are taken as well, to be marked again. The tallies stay
+        persisted until `settle` is called with the keys of the images that were marked.
+
+        Args:
+            force (bool, optional): Settle every pending tally. Defaults to False.
+
+        Returns:
+            Dict[int, Tuple[str, int, Optional[str]]]: The paths of the settled images, their scores and sources by
+                key, ready for `Evaluate.mark_many`.
+        """
+        now = time.time()
+        self._expire(now)
+        settled = [key for key, tally in self._tallies.items() if force or self.is_settled(tally, now)]
+        changed = [key for key, tally in self._settled.items() if self.aggregate(tally) != tally.score]
+        marks = {}
+        for key in settled:
+            tally = self._settling[key] = self._tallies.pop(key)
+            marks[key] = (tally.path, self.aggregate(tally), tally.source)
+        for key in changed:
+            tally = self._settling[key] = self._settled.pop(key)
+            marks[key] = (tally.path, self.aggregate(tally), tally.source)
+        return marks
+
+    def settle(self, marks: Dict[int, Tuple[str, int, Optional[str]]], marked: Dict[int, Optional[str]]) -> None:
+        """
+        Ends the marking of the tallies taken by `pop_settled`.
+
+        The marked images are remembered with their path in the store, the others are put back to be retried.
+
+        Args:
+            marks (Dict[int, Tuple[str, int, Optional[str]]]): The marks returned by `pop_settled`.
+            marked (Dict[int, Optional[str]]): The path every marked image was moved to by key, None for the
+                images that vanished before they could be marked.
+        """
+        now = time.time()
+        for key, (_, score, _) in marks.items():
+            tally = self._settling.pop(key, None)
+            if tally is None:
+                continue
+            if key in marked:
+                if marked[key] is None:
+                    continue
+                tally.path, tally.score = marked[key], score
+                tally.settled_at = tally.settled_at or now
+                self._settled[key] = tally
+            elif tally.score is None:
+                self._tallies[key] = tally
+            else:
+                self._settled[key] = tally
+        self.save()
+
+    def _expire(self, now: float) -> None:
+        while self._settled:
+            key, tally = next(iter(self._settled.items()))
+            if now - tally.settled_at < self._keep_seconds:
+                break
+            del self._settled[key]
+
+    def save(self) -> None:
+        temp_path = f"{self._save_path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    str(key): [
+                        tally.path,
+                        tally.source,
+                        tally.opened_at,
+                        tally.voters.tolist(),
+                        tally.scores.tolist(),
+                        tally.score,
+                        tally.settled_at,
+                    ]
+                    for key, tally in {**self._settled, **self._tallies, **self._settling}.items()
+                },
+                f,
+                ensure_ascii=False,
+            )
+        os.replace(temp_path, self._save_path)
+
+    def load(self) -> None:
+        with open(self._save_path, "r", encoding="utf-8") as f:
+            temp: Dict[str, list] = json.load(f)
+        settled = []
+        for key, (path, source, opened_at, voters, scores, *marked) in temp.items():
+            tally = VoteTally(path, opened_at, source)
+            tally.voters.extend(voters)
+            tally.scores.extend(scores)
+            if marked and marked[0] is not None:
+                tally.score, tally.settled_at = marked
+                settled.append((tally.settled_at, int(key), tally))
+            else:
+                self._tallies[int(key)] = tally
+        for _, key, tally in sorted(settled):
+            self._settled[key] = tally
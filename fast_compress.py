@@ -0,0 +1,215 @@
+import io
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import Optional, Tuple, List
+
+SENDABLE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".webp")
+
+# bits per pixel of a typical photo encoded as JPEG at a given quality, ascending
+_BPP_TABLE: List[Tuple[int, float]] = [
+    (10, 0.25),
+    (20, 0.4),
+    (30, 0.5),
+    (40, 0.65),
+    (50, 0.75),
+    (60, 0.9),
+    (70, 1.05),
+    (75, 1.2),
+    (80, 1.4),
+    (85, 1.7),
+    (90, 2.2),
+    (95, 3.2),
+]
+_QUALITIES = [quality for quality, _ in _BPP_TABLE]
+_BPPS = [bpp for _, bpp in _BPP_TABLE]
+
+QUALITY_FLOOR = 60
+SAFETY = 0.85
+# the quality a JPEG source is assumed to be saved at, when judging its complexity from its size
+SOURCE_QUALITY = 90
+
+
+def bits_per_pixel(quality: int) -> float:
+    """
+    Interpolates the expected bits per pixel of a JPEG encoded at the quality.
+    """
+    i = bisect_left(_QUALITIES, quality)
+    if i == 0:
+        return _BPPS[0]
+    if i == len(_QUALITIES):
+        return _BPPS[-1]
+    (q0, b0), (q1, b1) = _BPP_TABLE[i - 1], _BPP_TABLE[i]
+    return b0 + (b1 - b0) * (quality - q0) / (q1 - q0)
+
+
+def quality_for(bpp: float) -> int:
+    """
+    Interpolates the JPEG quality expected to spend the given bits per pixel, the inverse of `bits_per_pixel`.
+    """
+    i = bisect_left(_BPPS, bpp)
+    if i == 0:
+        return _QUALITIES[0]
+    if i == len(_BPPS):
+        return _QUALITIES[-1]
+    (q0, b0), (q1, b1) = _BPP_TABLE[i - 1], _BPP_TABLE[i]
+    return int(q0 + (q1 - q0) * (bpp - b0) / (b1 - b0))
+
+
+def source_complexity(pixels: int, source_bytes: int) -> float:
+    """
+    Estimates how many times the typical bits per pixel a JPEG source costs, clamped to [0.5, 2].
+    """
+    return min(2.0, max(0.5, source_bytes * 8 / max(pixels, 1) / bits_per_pixel(SOURCE_QUALITY)))
+
+
+def predict_quality(pixels: int, max_file_size: int, complexity: float = 1.0) -> int:
+    """
+    Predicts the JPEG quality that keeps an image of the given pixel count and complexity under the size limit.
+    """
+    return quality_for(max_file_size * 8 * SAFETY / max(pixels, 1) / complexity)
+
+
+def plan_scale(width: int, height: int, max_file_size: int, complexity: float = 1.0) -> int:
+    """
+    Picks the smallest downscale factor, among 1, 2, 4 and 8, at which the predicted quality reaches `QUALITY_FLOOR`.
+    """
+    for scale in (1, 2, 4):
+        if predict_quality((width // scale) * (height // scale), max_file_size, complexity) >= QUALITY_FLOOR:
+            return scale
+    return 8
+
+
+def fast_compress(
+    input_image_path: str,
+    output_image_path: str,
+    max_file_size: int,
+    hint: Optional[Tuple[int, int]] = None,
+    min_quality: int = 10,
+    max_passes: int = 3,
+) -> Tuple[int, int, int]:
+    """
+    Encodes an image as JPEG under the size limit, usually in a single pass.
+
+    The quality is taken from the hint of a previous run, or predicted from the pixel count and, for JPEG sources,
+    the bytes per pixel of the source. An image too large to reach `QUALITY_FLOOR` is decoded at a reduced
+    resolution, which JPEG sources support natively through draft mode. When an encode
+    overshoots, the next quality is derived from the measured bits per pixel.
+
+    Args:
+        input_image_path (str): The path of the source image.
+        output_image_path (str): The path to write the JPEG to.
+        max_file_size (int): The maximal size of the output in bytes.
+        hint (Tuple[int, int], optional): The quality and downscale factor that fit on a previous run.
+        min_quality (int, optional): The lowest quality tried. Defaults to 10.
+        max_passes (int, optional): The maximal number of encodes. Defaults to 3.
+
+    Returns:
+        Tuple[int, int, int]: The quality, the number of encodes and the downscale factor.
+
+    Raises:
+        ValueError: If the image is animated or does not fit after ``max_passes`` encodes.
+    """
+    from PIL import Image
+
+    with Image.open(input_image_path) as img:
+        if getattr(img, "is_animated", False):
+            raise ValueError("animated images are not re-encoded")
+        width, height = img.size
+        complexity = 1.0
+        if img.format == "JPEG":
+            complexity = source_complexity(width * height, os.path.getsize(input_image_path))
+        quality, scale = hint if hint else (None, plan_scale(width, height, max_file_size, complexity))
+        if scale > 1:
+            if img.format == "JPEG":
+                img.draft("RGB", (width // scale, height // scale))
+            img = img.reduce(max(1, min(img.size[0] // (width // scale), img.size[1] // (height // scale))))
+        img = img.convert("RGB")
+        pixels = img.size[0] * img.size[1]
+        if quality is None:
+            quality = max(min_quality, min(95, predict_quality(pixels, max_file_size, complexity)))
+        for passes in range(1, max_passes + 1):
+            buffer = io.BytesIO()
+            img.save(buffer, format="JPEG", quality=quality, optimize=True)
+            size = buffer.tell()
+            if size <= max_file_size:
+                with open(output_image_path, "wb") as f:
+                    f.write(buffer.getbuffer())
+                return quality, passes, scale
+            if quality <= min_quality:
+                break
+            # the image costs ``complexity`` times the typical bits per pixel, the next quality accounts for it
+            complexity = (size * 8 / pixels) / bits_per_pixel(quality)
+            target_bpp = max_file_size * 8 * SAFETY / pixels / complexity
+            quality = max(min_quality, min(quality - 5, quality_for(target_bpp)))
+    raise ValueError(f"{input_image_path} does not fit in {max_file_size} bytes")
+
+
+class QualityHints(object):
+    """
+    Remembers, per source, the quality and downscale factor that fitted the size limit, so the next compression of
+    the same source takes a single encode.
+
+    A hint is keyed by the absolute source path and only used while the mtime, the size and the limit are the
+    same. At most ``max_entries`` hints are kept, the least recently used are dropped first, and the hints are
+    saved at most every ``save_interval`` seconds.
+    """
+
+    def __init__(self, save_path: str, max_entries: int = 100000, save_interval: float = 30.0):
+        self._save_path: str = save_path
+        self._max_entries: int = max_entries
+        self._save_interval: float = save_interval
+        self._hints: "OrderedDict[str, list]" = OrderedDict()
+        self._last_save: float = time.monotonic()
+        self._dirty: bool = False
+        self._lock = threading.Lock()
+        if os.path.exists(save_path):
+            try:
+                with open(save_path, "r", encoding="utf-8") as f:
+                    self._hints.update(json.load(f))
+            except ValueError:
+                pass
+
+    @staticmethod
+    def _stamp(source_path: str, max_file_size: int) -> list:
+        stat = os.stat(source_path)
+        return [stat.st_mtime_ns, stat.st_size, max_file_size]
+
+    def get(self, source_path: str, max_file_size: int) -> Optional[Tuple[int, int]]:
+        key = os.path.abspath(source_path)
+        with self._lock:
+            entry = self._hints.get(key)
+            if entry is None:
+                return None
+            self._hints.move_to_end(key)
+        if entry[:3] != self._stamp(key, max_file_size):
+            return None
+        return entry[3], entry[4]
+
+    def put(self, source_path: str, max_file_size: int, quality: int, scale: int) -> None:
+        key = os.path.abspath(source_path)
+        entry = self._stamp(key, max_file_size) + [quality, scale]
+        with self._lock:
+            self._hints[key] = entry
+            self._hints.move_to_end(key)
+            while len(self._hints) > self._max_entries:
+                self._hints.popitem(last=False)
+            self._dirty = True
+            due = time.monotonic() - self._last_save >= self._save_interval
+        if due:
+            self.save()
+
+    def save(self) -> None:
+        with self._lock:
+            if not self._dirty:
+                return
+            snapshot = dict(self._hints)
+            self._dirty = False
+            self._last_save = time.monotonic()
+        temp_path = f"{self._save_path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f)
+        os.replace(temp_path, self._save_path)
@@ -0,0 +1,114 @@
+import asyncio
+import os
+import shutil
+from typing import Optional, Dict, List
+
+from modules.shared import download_file
+
+from .img_manager import ImageRegistry
+from .metrics import metrics
+
+
+def link_or_copy(source_path: str, target_path: str) -> str:
+    """
+    Hard-links the source to the target, falling back to a copy across file systems.
+
+    Args:
+        source_path (str): The file to link.
+        target_path (str): The path of the new link, which must not exist.
+
+    Returns:
+        str: The target path.
+
+    Raises:
+        FileExistsError: If the target already exists.
+    """
+    try:
+        os.link(source_path, target_path)
+    except FileExistsError:
+        raise
+    except OSError:
+        if os.path.exists(target_path):
+            raise FileExistsError(target_path)
+        shutil.copy2(source_path, target_path)
+    return target_path
+
+
+class ImageFetcher(object):
+    """
+    Provides a private local copy of a quoted image, for it to be marked.
+
+    Images the bot sent itself are found in the `ImageRegistry` and hard-linked from their local original, without
+    any download. Foreign images are downloaded to a staging dir, and concurrent fetches of one url share a single
+    download. Every caller gets a link of its own, so marking one of them never pulls the file from under another.
+    """
+
+    def __init__(self, cache_dir: str, registry: ImageRegistry):
+        """
+        Initializes the ImageFetcher.
+
+        Args:
+            cache_dir (str): The dir the private copies are placed in.
+            registry (ImageRegistry): The registry of the images sent by the bot.
+        """
+        self._cache_dir: str = cache_dir
+        self._staging_dir: str = f"{cache_dir}/downloads"
+        os.makedirs(self._staging_dir, exist_ok=True)
+        self._registry: ImageRegistry = registry
+        self._inflight: Dict[str, List] = {}
+
+    def resolve_local(self, message_id: int) -> Optional[str]:
+        """
+        Links the local original of an image sent by the bot.
+
+        Args:
+            message_id (int): The id of the message that carried the image.
+
+        Returns:
+            Optional[str]: The path of the private copy, or None if the message is unknown or its file is gone.
+        """
+        record = self._registry.images_registry.get(message_id)
+        if record is None or not os.path.exists(record.path):
+            return None
+        return self._link(record.path)
+
+    async def download(self, url: str) -> str:
+        """
+        Downloads an image, sharing the download with concurrent callers of the same url.
+
+        Args:
+            url (str): The url of the image.
+
+        Returns:
+            str: The path of the private copy.
+        """
+        entry = self._inflight.get(url)
+        if entry is None:
+            entry = [asyncio.ensure_future(download_file(url, self._staging_dir)), 0]
+            self._inflight[url] = entry
+        task: asyncio.Task = entry[0]
+        entry[1] += 1
+        try:
+            with metrics.timer("download_seconds"):
+                source_path = await asyncio.shield(task)
+            return self._link(source_path)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._inflight[url]
+                task.add_done_callback(self._discard)
+
+    @staticmethod
+    def _discard(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is None and os.path.exists(task.result()):
+            os.remove(task.result())
+
+    def _link(self, source_path: str) -> str:
+        stem, ext = os.path.splitext(os.path.basename(source_path))
+        suffix = 0
+        while True:
+            name = f"{stem}_{suffix}{ext}" if suffix else f"{stem}{ext}"
+            try:
+                return link_or_copy(source_path, f"{self._cache_dir}/{name}")
+            except FileExistsError:
+                suffix += 1
@@ -0,0 +1,590 @@
+import hashlib
+import hmac
+import json
+import mmap
+import os
+import struct
+import sys
+import warnings
+from array import array
+from random import randrange
+from typing import List, Dict, Sequence, Optional, Tuple, Set, Union, BinaryIO, Iterable
+
+_EMPTY_DIRS = memoryview(b"").cast("I")
+_EMPTY_OFFSETS = memoryview(struct.pack("=Q", 0)).cast("Q")
+_BYTE_ORDER = 1 if sys.byteorder == "little" else 2
+
+
+class FileIndex(object):
+    """
+    A persistent index of every file below a set of asset roots.
+
+    Every indexed directory is recorded together with its ``st_mtime_ns`` and its sub-directories, so a refresh
+    only lists the directories whose entries changed since the last scan. Unchanged directories are walked through
+    their recorded sub-directories without being listed again.
+
+    Entry names live in a single UTF-8 blob that is memory-mapped from the index file, addressed by an offsets
+    array, so only the drawn entry is ever decoded. Entries added after loading go to an in-memory tail, and a
+    missing entry is dropped in O(1) by swapping the last entry into its place.
+
+    File layout, all integers in native byte order and every section aligned to 8 bytes::
+
+        header | meta (json) | dir ids (uint32 * n) | offsets (uint64 * (n + 1)) | blob | hmac-sha256
+    """
+
+    VERSION = 2
+    MAGIC = b"PEFIDX\x00\x02"
+    _HEADER = struct.Struct("=8sIIQQQ")
+    _SIGNATURE_SIZE = 32
+    _CHUNK_SIZE = 1 << 20
+
+    def __init__(self, roots: Sequence[str], ignore_dirs: Sequence[str] = tuple()):
+        """
+        Initializes an empty FileIndex.
+
+        Args:
+            roots (Sequence[str]): The root directories to index.
+            ignore_dirs (Sequence[str], optional): Directory names or paths that are not descended into.
+        """
+        self._roots: List[str] = list(roots)
+        self._ignore_dirs: List[str] = list(ignore_dirs)
+
+        self._dir_ids: Dict[str, int] = {}
+        self._dir_paths: List[Optional[str]] = []
+        self._dir_mtimes: List[int] = []
+        self._dir_subdirs: List[Tuple[str, ...]] = []
+
+        self._mmap: Optional[mmap.mmap] = None
+        self._view: Optional[memoryview] = None
+        self._blob: Union[memoryview, bytes] = b""
+        self._base_dirs: memoryview = _EMPTY_DIRS
+        self._base_offsets: memoryview = _EMPTY_OFFSETS
+        self._base_len: int = 0
+        self._moved: Dict[int, Tuple[int, int, int]] = {}
+
+        self._tail: bytearray = bytearray()
+        self._extra_dirs: array = array("I")
+        self._extra_starts: array = array("Q")
+        self._extra_ends: array = array("Q")
+
+        self._dirty: bool = False
+        self._version: int = 0
+
+    def __len__(self) -> int:
+        return self._base_len + len(self._extra_dirs)
+
+    @property
+    def roots(self) -> Tuple[str, ...]:
+        return tuple(self._roots)
+
+    @property
+    def dirty(self) -> bool:
+        """
+        Whether the index changed since it was last dumped or loaded.
+        """
+        return self._dirty
+
+    def _touch(self) -> None:
+        self._dirty = True
+        self._version += 1
+
+    def matches(self, roots: Sequence[str], ignore_dirs: Sequence[str]) -> bool:
+        """
+        Checks whether the index was built for the given roots and ignore list.
+
+        Args:
+            roots (Sequence[str]): The expected root directories.
+            ignore_dirs (Sequence[str]): The expected ignore list.
+
+        Returns:
+            bool: True if the index covers exactly these roots with the same ignore list.
+        """
+        return self._roots == list(roots) and sorted(self._ignore_dirs) == sorted(ignore_dirs)
+
+    def _entry(self, position: int) -> Tuple[int, int, int]:
+        if position >= self._base_len:
+            position -= self._base_len
+            return self._extra_dirs[position], self._extra_starts[position], self._extra_ends[position]
+        moved = self._moved.get(position)
+        if moved is not None:
+            return moved
+        return self._base_dirs[position], self._base_offsets[position], self._base_offsets[position + 1]
+
+    def _set_entry(self, position: int, entry: Tuple[int, int, int]) -> None:
+        if position >= self._base_len:
+            position -= self._base_len
+            self._extra_dirs[position], self._extra_starts[position], self._extra_ends[position] = entry
+        else:
+            self._moved[position] = entry
+
+    def _name(self, start: int, end: int) -> str:
+        blob_len = len(self._blob)
+        if start >= blob_len:
+            return self._tail[start - blob_len : end - blob_len].decode("utf-8")
+        return bytes(self._blob[start:end]).decode("utf-8")
+
+    def path_at(self, position: int) -> str:
+        """
+        Returns the path of the entry at the given position, decoding only that entry.
+        """
+        dir_id, start, end = self._entry(position)
+        return os.path.join(self._dir_paths[dir_id], self._name(start, end))
+
+    def random_position(self) -> int:
+        """
+        Returns a uniformly drawn entry position.
+
+        Raises:
+            IndexError: If the index is empty.
+        """
+        if not len(self):
+            raise IndexError("random_position from an empty index")
+        return randrange(len(self))
+
+    def remove_at(self, position: int) -> None:
+        """
+        Removes the entry at the given position by swapping the last entry into its place.
+
+        Args:
+            position (int): The position of the entry to remove.
+        """
+        last = len(self) - 1
+        if position != last:
+            self._set_entry(position, self._entry(last))
+        if self._extra_dirs:
+            self._extra_dirs.pop()
+            self._extra_starts.pop()
+            self._extra_ends.pop()
+        else:
+            self._moved.pop(last, None)
+            self._base_len -= 1
+        self._touch()
+
+    def _append(self, dir_id: int, name: str) -> None:
+        start = len(self._blob) + len(self._tail)
+        self._tail += name.encode("utf-8")
+        self._extra_dirs.append(dir_id)
+        self._extra_starts.append(start)
+        self._extra_ends.append(len(self._blob) + len(self._tail))
+
+    def _entry_dir_ids(self) -> List[int]:
+        dir_ids = self._base_dirs[: self._base_len].tolist()
+        for position, (dir_id, _, _) in self._moved.items():
+            dir_ids[position] = dir_id
+        dir_ids.extend(self._extra_dirs)
+        return dir_ids
+
+    def refresh(self, dir_paths: Optional[Iterable[str]] = None) -> Tuple[int, int]:
+        """
+        Brings the index up to date with the file system, see `scan` and `apply`.
+
+        Args:
+            dir_paths (Iterable[str], optional): Only refresh these directories instead of the whole index.
+
+        Returns:
+            Tuple[int, int]: The number of added and removed entries.
+        """
+        return self.apply(self.scan(dir_paths))
+
+    def scan(self, dir_paths: Optional[Iterable[str]] = None) -> "IndexDelta":
+        """
+        Collects the changes of the file system since the last refresh, without modifying the index.
+
+        A full scan walks the roots, skips the directories whose mtime did not change and lists the others again.
+        Directories that disappeared are reported together with their descendants.
+
+        A targeted scan lists the given directories regardless of their mtime and descends only into their new
+        sub-directories, which is what a file system watcher needs once it knows which directories changed.
+
+        Only the directory records of the index are read, so the scan may run without holding the lock that
+        guards the entries, as long as neither another scan nor a `dump`, which rebuilds those records, runs
+        concurrently.
+
+        Args:
+            dir_paths (Iterable[str], optional): The directories to list, the whole index if not given.
+
+        Returns:
+            IndexDelta: The changes, to be passed to `apply`.
+        """
+        full = dir_paths is None
+        if full:
+            stack = list(reversed(self._roots))
+            forced: Set[str] = set()
+        else:
+            root_prefixes = tuple(os.path.join(root, "") for root in self._roots)
+            stack = [path for path in dir_paths if path in self._roots or path.startswith(root_prefixes)]
+            forced = set(stack)
+        delta = IndexDelta()
+        seen: Set[str] = set()
+        while stack:
+            dir_path = stack.pop()
+            if dir_path in seen:
+                continue
+            try:
+                mtime_ns = os.stat(dir_path).st_mtime_ns
+            except OSError:
+                continue
+            seen.add(dir_path)
+            dir_id = self._dir_ids.get(dir_path)
+            if dir_id is not None and dir_path not in forced and self._dir_mtimes[dir_id] == mtime_ns:
+                if full:
+                    stack.extend(self._dir_subdirs[dir_id])
+                continue
+            files, subdirs = self._list_dir(dir_path)
+            delta.listings[dir_path] = (mtime_ns, files, subdirs)
+            if dir_id is not None and not full:
+                delta.vanished.update(set(self._dir_subdirs[dir_id]) - set(subdirs))
+            stack.extend(subdirs)
+
+        if full:
+            delta.vanished.update(path for path in self._dir_ids if path not in seen)
+        else:
+            delta.vanished.update(path for path in forced if path not in seen)
+            if delta.vanished:
+                prefixes = tuple(os.path.join(path, "") for path in delta.vanished)
+                delta.vanished.update(path for path in self._dir_ids if path.startswith(prefixes))
+        return delta
+
+    def apply(self, delta: "IndexDelta") -> Tuple[int, int]:
+        """
+        Applies the changes collected by `scan` to the index.
+
+        Entries of the listed directories are matched against their new listing and entries of the vanished
+        directories are dropped, all in a single pass over the entries.
+
+        Args:
+            delta (IndexDelta): The changes returned by `scan`.
+
+        Returns:
+            Tuple[int, int]: The number of added and removed entries.
+        """
+        changed: Dict[int, Set[str]] = {}
+        added: List[Tuple[int, str]] = []
+        for dir_path, (mtime_ns, files, subdirs) in delta.listings.items():
+            dir_id = self._dir_ids.get(dir_path)
+            if dir_id is None:
+                dir_id = self._add_dir(dir_path)
+                added.extend((dir_id, name) for name in files)
+            else:
+                changed[dir_id] = set(files)
+            self._dir_mtimes[dir_id] = mtime_ns
+            self._dir_subdirs[dir_id] = tuple(subdirs)
+            self._touch()
+
+        vanished: Set[int] = set()
+        for dir_path in delta.vanished:
+            if dir_path in self._dir_ids and dir_path not in delta.listings:
+                vanished.add(self._drop_dir(dir_path))
+
+        removed = 0
+        if changed or vanished:
+            known: Dict[int, Set[str]] = {dir_id: set() for dir_id in changed}
+            doomed: List[int] = []
+            for position, dir_id in enumerate(self._entry_dir_ids()):
+                if dir_id in vanished:
+                    doomed.append(position)
+                elif dir_id in changed:
+                    _, start, end = self._entry(position)
+                    name = self._name(start, end)
+                    if name in changed[dir_id]:
+                        known[dir_id].add(name)
+                    else:
+                        doomed.append(position)
+            for position in reversed(doomed):
+                self.remove_at(position)
+            removed = len(doomed)
+            for dir_id, listing in changed.items():
+                added.extend((dir_id, name) for name in listing - known[dir_id])
+
+        for dir_id, name in added:
+            self._append(dir_id, name)
+        if added or removed:
+            self._touch()
+        return len(added), removed
+
+    def dir_paths(self) -> List[str]:
+        """
+        Returns the paths of all indexed directories.
+        """
+        return list(self._dir_ids)
+
+    def _list_dir(self, dir_path: str) -> Tuple[List[str], List[str]]:
+        files: List[str] = []
+        subdirs: List[str] = []
+        try:
+            with os.scandir(dir_path) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir():
+                            if entry.name not in self._ignore_dirs and entry.path not in self._ignore_dirs:
+                                subdirs.append(entry.path)
+                        elif entry.is_file():
+                            files.append(entry.name)
+                    except OSError:
+                        continue
+        except OSError:
+            pass
+        return files, subdirs
+
+    def _add_dir(self, dir_path: str) -> int:
+        dir_id = len(self._dir_paths)
+        self._dir_ids[dir_path] = dir_id
+        self._dir_paths.append(dir_path)
+        self._dir_mtimes.append(0)
+        self._dir_subdirs.append(tuple())
+        return dir_id
+
+    def _drop_dir(self, dir_path: str) -> int:
+        dir_id = self._dir_ids.pop(dir_path)
+        self._dir_paths[dir_id] = None
+        self._dir_subdirs[dir_id] = tuple()
+        self._touch()
+        return dir_id
+
+    def dump(self, file_path: str, key: bytes) -> None:
+        """
+        Writes the index to the given path and re-maps it from there, see `snapshot`, `IndexSnapshot.write` and
+        `adopt`.
+
+        Args:
+            file_path (str): The path of the index file.
+            key (bytes): The key used to sign the file.
+        """
+        snapshot = self.snapshot()
+        self.adopt(snapshot, snapshot.write(file_path, key), file_path)
+
+    def snapshot(self) -> "IndexSnapshot":
+        """
+        Copies the entry tables of the index, so it can be written without holding the lock that guards them.
+
+        Only flat arrays are copied, the mapped blob is shared, since mapped entries are never changed in place.
+        """
+        base_len = self._base_len
+        snapshot = IndexSnapshot()
+        snapshot.version = self._version
+        snapshot.remap = {}
+        dirs: List[Tuple[str, int, Tuple[str, ...]]] = []
+        for dir_id, dir_path in enumerate(self._dir_paths):
+            if dir_path is None:
+                continue
+            snapshot.remap[dir_id] = len(dirs)
+            dirs.append((dir_path, self._dir_mtimes[dir_id], self._dir_subdirs[dir_id]))
+        snapshot.meta = {"roots": list(self._roots), "ignore_dirs": list(self._ignore_dirs), "dirs": dirs}
+        snapshot.dir_ids = array("I", self._base_dirs[:base_len].tobytes())
+        snapshot.offsets = array("Q", self._base_offsets[: base_len + 1].tobytes())
+        snapshot.moved = dict(self._moved)
+        snapshot.extra_dirs = array("I", self._extra_dirs)
+        snapshot.extra_starts = array("Q", self._extra_starts)
+        snapshot.extra_ends = array("Q", self._extra_ends)
+        snapshot.blob = self._blob
+        snapshot.tail = bytes(self._tail)
+        return snapshot
+
+    def adopt(self, snapshot: "IndexSnapshot", temp_path: str, file_path: str) -> bool:
+        """
+        Moves the file written from a snapshot into place and re-maps the index from there, unless the index
+        changed since the snapshot, in which case the file is still kept but the index stays dirty.
+
+        Args:
+            snapshot (IndexSnapshot): The snapshot returned by `snapshot`.
+            temp_path (str): The path returned by `IndexSnapshot.write`.
+            file_path (str): The path of the index file.
+
+        Returns:
+            bool: True if the index now maps the file and is clean.
+        """
+        if snapshot.version != self._version:
+            try:
+                os.replace(temp_path, file_path)
+            except OSError:
+                # the current file is still mapped on platforms that can not replace it
+                os.remove(temp_path)
+            return False
+        self._close()
+        try:
+            os.replace(temp_path, file_path)
+        except OSError:
+            self._map(temp_path, verify=None)
+            raise
+        self._map(file_path, verify=None)
+        self._dirty = False
+        return True
+
+    @staticmethod
+    def _write(f: BinaryIO, mac: "hmac.HMAC", data: Union[bytes, bytearray], align: bool = False) -> None:
+        if align and len(data) % 8:
+            data = bytes(data) + b"\x00" * (8 - len(data) % 8)
+        f.write(data)
+        mac.update(data)
+
+    @classmethod
+    def load(cls, file_path: str, key: bytes) -> Optional["FileIndex"]:
+        """
+        Maps an index file written by `dump`.
+
+        Args:
+            file_path (str): The path of the index file.
+            key (bytes): The key the file was signed with.
+
+        Returns:
+            Optional[FileIndex]: The loaded index, or None if the file is not a valid, correctly signed index.
+        """
+        index = cls([])
+        try:
+            if index._map(file_path, verify=key):
+                return index
+        except (OSError, ValueError, struct.error) as e:
+            warnings.warn(f"Failed to load file index at {file_path}: {e}")
+        index._close()
+        return None
+
+    def _map(self, file_path: str, verify: Optional[bytes]) -> bool:
+        with open(file_path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < self._HEADER.size + self._SIGNATURE_SIZE:
+                return False
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, byte_order, meta_len, count, blob_len = self._HEADER.unpack_from(mm, 0)
+        if magic != self.MAGIC or version != self.VERSION or byte_order != _BYTE_ORDER:
+            mm.close()
+            return False
+        if verify is not None:
+            mac = hmac.new(verify, digestmod=hashlib.sha256)
+            body_size = size - self._SIGNATURE_SIZE
+            for chunk_start in range(0, body_size, self._CHUNK_SIZE):
+                mac.update(mm[chunk_start : min(chunk_start + self._CHUNK_SIZE, body_size)])
+            if not hmac.compare_digest(mm[body_size:size], mac.digest()):
+                warnings.warn(f"Invalid signature of file index at {file_path}")
+                mm.close()
+                return False
+
+        cursor = self._HEADER.size
+        meta = json.loads(mm[cursor : cursor + meta_len].decode("utf-8"))
+        cursor += _aligned(meta_len)
+        view = memoryview(mm)
+        self._base_dirs = view[cursor : cursor + 4 * count].cast("I")
+        cursor += _aligned(4 * count)
+        self._base_offsets = view[cursor : cursor + 8 * (count + 1)].cast("Q")
+        cursor += _aligned(8 * (count + 1))
+        self._blob = view[cursor : cursor + blob_len]
+        self._view = view
+        self._mmap = mm
+        self._base_len = count
+        self._moved = {}
+        self._tail = bytearray()
+        self._extra_dirs, self._extra_starts, self._extra_ends = array("I"), array("Q"), array("Q")
+
+        self._roots = meta["roots"]
+        self._ignore_dirs = meta["ignore_dirs"]
+        self._dir_ids, self._dir_paths, self._dir_mtimes, self._dir_subdirs = {}, [], [], []
+        for dir_path, mtime_ns, subdirs in meta["dirs"]:
+            dir_id = self._add_dir(dir_path)
+            self._dir_mtimes[dir_id] = mtime_ns
+            self._dir_subdirs[dir_id] = tuple(subdirs)
+        return True
+
+    def _close(self) -> None:
+        if self._mmap is None:
+            return
+        self._base_dirs.release()
+        self._base_offsets.release()
+        self._blob.release()
+        self._view.release()
+        self._view = None
+        self._base_dirs, self._base_offsets, self._blob = _EMPTY_DIRS, _EMPTY_OFFSETS, b""
+        self._mmap.close()
+        self._mmap = None
+
+
+class IndexSnapshot(object):
+    """
+    A copy of the entry tables of a `FileIndex`, taken by `FileIndex.snapshot` to be written without its lock.
+    """
+
+    __slots__ = (
+        "version", "remap", "meta", "dir_ids", "offsets", "moved", "extra_dirs", "extra_starts", "extra_ends", "blob",
+        "tail",
+    )
+
+    def _entry(self, position: int) -> Tuple[int, int, int]:
+        base_len = len(self.dir_ids)
+        if position >= base_len:
+            position -= base_len
+            return self.extra_dirs[position], self.extra_starts[position], self.extra_ends[position]
+        moved = self.moved.get(position)
+        if moved is not None:
+            return moved
+        return self.dir_ids[position], self.offsets[position], self.offsets[position + 1]
+
+    def write(self, file_path: str, key: bytes) -> str:
+        """
+        Writes the snapshot in the layout of `FileIndex` to a temporary path next to the index file, which
+        `FileIndex.adopt` moves into place.
+
+        The HMAC is computed while streaming, so no second copy of the index is built in memory.
+
+        Args:
+            file_path (str): The path of the index file.
+            key (bytes): The key used to sign the file.
+
+        Returns:
+            str: The temporary path.
+        """
+        meta = json.dumps(self.meta, ensure_ascii=False).encode("utf-8")
+
+        count = len(self.dir_ids) + len(self.extra_dirs)
+        dir_ids = array("I")
+        offsets = array("Q", [0])
+        blob_len = 0
+        for position in range(count):
+            dir_id, start, end = self._entry(position)
+            dir_ids.append(self.remap[dir_id])
+            blob_len += end - start
+            offsets.append(blob_len)
+
+        temp_path = f"{file_path}.tmp"
+        mac = hmac.new(key, digestmod=hashlib.sha256)
+        write = FileIndex._write
+        with open(temp_path, "wb") as f:
+            header = FileIndex._HEADER.pack(FileIndex.MAGIC, FileIndex.VERSION, _BYTE_ORDER, len(meta), count, blob_len)
+            write(f, mac, header)
+            write(f, mac, meta, align=True)
+            write(f, mac, dir_ids.tobytes(), align=True)
+            write(f, mac, offsets.tobytes(), align=True)
+            del dir_ids, offsets
+            buffer = bytearray()
+            blob_size = len(self.blob)
+            for position in range(count):
+                _, start, end = self._entry(position)
+                if start >= blob_size:
+                    buffer += self.tail[start - blob_size : end - blob_size]
+                else:
+                    buffer += self.blob[start:end]
+                if len(buffer) >= FileIndex._CHUNK_SIZE:
+                    write(f, mac, buffer)
+                    buffer = bytearray()
+            write(f, mac, buffer)
+            f.write(mac.digest())
+            f.flush()
+            os.fsync(f.fileno())
+        # the mapped blob must not outlive the mapping, which `FileIndex.adopt` closes
+        self.blob = b""
+        return temp_path
+
+
+class IndexDelta(object):
+    """
+    The changes found by `FileIndex.scan`: the new listing of every new or changed directory, and the paths of the
+    directories that vanished.
+    """
+
+    __slots__ = ("listings", "vanished")
+
+    def __init__(self):
+        self.listings: Dict[str, Tuple[int, List[str], List[str]]] = {}
+        self.vanished: Set[str] = set()
+
+
+def _aligned(size: int) -> int:
+    return (size + 7) & ~7
+
@@ -1,22 +1,89 @@
 import json
 import os
 import shutil
+import struct
 import time
+from collections import OrderedDict
 from types import MappingProxyType
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, BinaryIO, Tuple, Iterator, Union
 
+from .metrics import metrics
 
-class ImageRegistry(object):  # TODO use other high performance serialize toolchain
-    def __init__(self, save_path: str, recycle_folder: Optional[str] = None, max_size: Optional[int] = None) -> None:
+
+class ImageRecord(object):
+    """
+    A registered image, the local path it was sent from and the time it was registered at.
+    """
+
+    __slots__ = ("path", "timestamp")
+
+    def __init__(self, path: str, timestamp: float):
+        self.path: str = path
+        self.timestamp: float = timestamp
+
+    def __iter__(self) -> Iterator[Union[str, float]]:
+        return iter((self.path, self.timestamp))
+
+    def __repr__(self) -> str:
+        return f"ImageRecord({self.path!r}, {self.timestamp!r})"
+
+
+class ImageRegistry(object):
+    """
+    A registry mapping sent message ids to the local path of the image they carry.
+
+    Changes are appended to a binary journal next to the snapshot instead of rewriting the whole registry.
+    Once the journal grows larger than both ``compact_threshold`` records and the registry itself, the registry
+    is compacted into a new snapshot that atomically replaces the old one, and the journal is emptied.
+
+    Both files are sequences of records of the form ``op | key | timestamp | path length | path`` behind a magic
+    header. A torn record at the end of the journal, left by a crash during a write, is discarded on load.
+
+    Records are kept in registration order, re-registering a key moves it to the end, so the oldest record is
+    always the first one and is evicted in O(1).
+    """
+
+    MAGIC = b"PEREG\x00\x01\n"
+    OP_REGISTER = 1
+    OP_REMOVE = 2
+    _RECORD = struct.Struct("<BqdI")
+
+    def __init__(
+        self,
+        save_path: str,
+        recycle_folder: Optional[str] = None,
+        max_size: Optional[int] = None,
+        compact_threshold: int = 4096,
+        legacy_path: Optional[str] = None,
+    ) -> None:
+        """
+        Initializes the registry and replays its snapshot and journal.
+
+        Args:
+            save_path (str): The path of the snapshot, the journal is kept at ``{save_path}.journal``.
+            recycle_folder (str, optional): The folder removed images are moved to, they are deleted if not given.
+            max_size (int, optional): The maximal number of registered images.
+            compact_threshold (int, optional): The number of journal records that may trigger a compaction.
+            legacy_path (str, optional): A json registry of the previous format that is imported if no snapshot
+                exists yet, and deleted once imported.
+        """
         self._save_path = save_path
+        self._journal_path = f"{save_path}.journal"
         self._max_size = max_size
+        self._compact_threshold = compact_threshold
         if recycle_folder:
             os.makedirs(recycle_folder, exist_ok=True)
         self._recycle_folder = recycle_folder
-        self._images_registry: Dict[int, List[str, float]] = {}
-        if os.path.exists(self._save_path):
+        self._images_registry: "OrderedDict[int, ImageRecord]" = OrderedDict()
+        self._journal: Optional[BinaryIO] = None
+        self._journal_records: int = 0
+        if legacy_path and os.path.exists(legacy_path) and not os.path.exists(self._save_path):
+            self._load_legacy(legacy_path)
+            self.save()
+            os.remove(legacy_path)
+        else:
             self.load()
-        self._images_registry_proxy: MappingProxyType[int, List[str, float]] = MappingProxyType(self._images_registry)
+        self._images_registry_proxy: MappingProxyType[int, ImageRecord] = MappingProxyType(self._images_registry)
 
     @property
     def images_registry(self) -> MappingProxyType:
@@ -39,9 +106,13 @@ class ImageRegistry(object):  # TODO use other high performance serialize toolch
         Returns:
             None: This function does not return anything.
         """
-        self._images_registry[key] = [image_path, time.time()]
+        key = int(key)
+        timestamp = time.time()
+        self._set(key, ImageRecord(image_path, timestamp))
+        self._append(self.OP_REGISTER, key, timestamp, image_path)
         self.prune()
-        self.save()
+        self._flush()
+        self._maybe_compact()
 
     def prune(self) -> None:
         """
@@ -64,7 +135,11 @@ class ImageRegistry(object):  # TODO use other high performance serialize toolch
                 self._remove_oldest()
 
     def get(self, key: int) -> str:
-        return self._images_registry[key][0]
+        return self._images_registry[int(key)].path
+
+    def _set(self, key: int, record: ImageRecord) -> None:
+        self._images_registry[key] = record
+        self._images_registry.move_to_end(key)
 
     def remove(self, key: int, save: bool = False) -> bool:
         """
@@ -72,32 +147,123 @@ class ImageRegistry(object):  # TODO use other high performance serialize toolch
 
         Args:
             key (int): The key of the image to remove.
-            save (bool, optional): Indicates whether to save the changes to the registry. Defaults to False.
+            save (bool, optional): Indicates whether to sync the journal to disk right away. Defaults to False.
 
         Returns:
             bool: True if the image was successfully removed, False otherwise.
         """
+        key = int(key)
         if key in self._images_registry:
-            file_path = self._images_registry[key][0]
+            file_path = self._images_registry[key].path
             if self._recycle_folder:
                 shutil.move(file_path, self._recycle_folder)
             else:
                 os.remove(file_path)
             del self._images_registry[key]
-            if save:
-                self.save()
+            self._append(self.OP_REMOVE, key)
+            self._flush(sync=save)
+            self._maybe_compact()
             return True
         return False
 
     def _remove_oldest(self) -> None:
-        oldest_key = min(self._images_registry, key=lambda k: self._images_registry[k][1])
-        del self._images_registry[oldest_key]
+        oldest_key, _ = self._images_registry.popitem(last=False)
+        self._append(self.OP_REMOVE, oldest_key)
+
+    def _append(self, op: int, key: int, timestamp: float = 0.0, image_path: str = "") -> None:
+        if self._journal is None:
+            self._open_journal()
+        path = image_path.encode("utf-8", "surrogateescape")
+        self._journal.write(self._RECORD.pack(op, key, timestamp, len(path)) + path)
+        self._journal_records += 1
+
+    def _flush(self, sync: bool = False) -> None:
+        if self._journal is None:
+            return
+        with metrics.timer("registry_save_seconds"):
+            self._journal.flush()
+            if sync:
+                os.fsync(self._journal.fileno())
+
+    def _maybe_compact(self) -> None:
+        if self._journal_records > max(self._compact_threshold, len(self._images_registry)):
+            self.save()
+
+    def _open_journal(self) -> None:
+        self._journal = open(self._journal_path, "ab")
+        if self._journal.tell() == 0:
+            self._journal.write(self.MAGIC)
 
     def save(self) -> None:
-        with open(self._save_path, "w", encoding="utf-8") as f:
-            json.dump(self._images_registry, f, ensure_ascii=False, indent=2)
+        """
+        Compacts the registry into a new snapshot and empties the journal.
+
+        The snapshot is written to a temporary file, synced and moved over the old one, so a crash leaves either
+        the old snapshot with its journal or the new snapshot in place.
+        """
+        temp_path = f"{self._save_path}.tmp"
+        with metrics.timer("registry_compact_seconds"), open(temp_path, "wb") as f:
+            f.write(self.MAGIC)
+            for key, record in self._images_registry.items():
+                path = record.path.encode("utf-8", "surrogateescape")
+                f.write(self._RECORD.pack(self.OP_REGISTER, key, record.timestamp, len(path)) + path)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self._save_path)
+        if self._journal is not None:
+            self._journal.close()
+        self._journal = open(self._journal_path, "wb")
+        self._journal.write(self.MAGIC)
+        self._journal.flush()
+        self._journal_records = 0
 
     def load(self) -> None:
-        with open(self._save_path, "r", encoding="utf-8") as f:
-            temp: Dict[int, List[str, float]] = json.load(f)
-        self._images_registry.update(temp)
+        """
+        Replays the snapshot and then the journal into the registry.
+        """
+        if os.path.exists(self._save_path):
+            self._replay(self._save_path)
+        if os.path.exists(self._journal_path):
+            self._journal_records, valid_size = self._replay(self._journal_path)
+            if valid_size < os.path.getsize(self._journal_path):
+                os.truncate(self._journal_path, valid_size)
+
+    def _replay(self, file_path: str) -> Tuple[int, int]:
+        with open(file_path, "rb") as f:
+            data = f.read()
+        if not data.startswith(self.MAGIC):
+            return 0, 0
+        record_size = self._RECORD.size
+        offset = len(self.MAGIC)
+        count = 0
+        set_record = self._set
+        while offset + record_size <= len(data):
+            op, key, timestamp, path_len = self._RECORD.unpack_from(data, offset)
+            end = offset + record_size + path_len
+            if end > len(data):
+                break
+            if op == self.OP_REGISTER:
+                image_path = data[offset + record_size : end].decode("utf-8", "surrogateescape")
+                set_record(key, ImageRecord(image_path, timestamp))
+            elif op == self.OP_REMOVE:
+                self._images_registry.pop(key, None)
+            else:
+                break
+            offset = end
+            count += 1
+        return count, offset
+
+    def _load_legacy(self, legacy_path: str) -> None:
+        with open(legacy_path, "r", encoding="utf-8") as f:
+            temp: Dict[str, List[str, float]] = json.load(f)
+        for key, (image_path, timestamp) in sorted(temp.items(), key=lambda item: item[1][1]):
+            self._set(int(key), ImageRecord(image_path, timestamp))
+
+    def close(self) -> None:
+        """
+        Syncs and closes the journal.
+        """
+        if self._journal is not None:
+            self._flush(sync=True)
+            self._journal.close()
+            self._journal = None
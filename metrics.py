@@ -0,0 +1,271 @@
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import List, Dict, Any, Callable, Sequence, Tuple
+
+
+class Counter(object):
+    """
+    A monotonically increasing count.
+    """
+
+    def __init__(self):
+        self._value: float = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> float:
+        return self._value
+
+
+class Histogram(object):
+    """
+    A distribution of observed values over fixed bucket bounds.
+
+    Quantiles are estimated from the buckets, so they are only as exact as the bounds, but observing is O(log b)
+    and the memory does not grow with the number of observations.
+    """
+
+    # 0.1 ms to about 100 s, roughly three buckets per decade
+    DEFAULT_BOUNDS: Tuple[float, ...] = tuple(round(10 ** (exp / 3) * 1e-4, 7) for exp in range(19))
+
+    def __init__(self, bounds: Sequence[float] = DEFAULT_BOUNDS):
+        """
+        Initializes the Histogram.
+
+        Args:
+            bounds (Sequence[float], optional): The ascending upper bounds of the buckets, an overflow bucket is
+                added. Defaults to `DEFAULT_BOUNDS`, suited to durations in seconds.
+        """
+        self._bounds: Tuple[float, ...] = tuple(bounds)
+        self._buckets: List[int] = [0] * (len(self._bounds) + 1)
+        self._count: int = 0
+        self._sum: float = 0.0
+        self._max: float = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            self._buckets[bisect_left(self._bounds, value)] += 1
+            self._count += 1
+            self._sum += value
+            self._max = max(self._max, value)
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    @property
+    def sum(self) -> float:
+        return self._sum
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimates a quantile as the upper bound of the bucket it falls into, capped by the largest observation.
+        """
+        with self._lock:
+            if not self._count:
+                return 0.0
+            rank = q * self._count
+            seen = 0
+            for i, count in enumerate(self._buckets):
+                seen += count
+                if seen >= rank and count:
+                    return min(self._bounds[i], self._max) if i < len(self._bounds) else self._max
+            return self._max
+
+    def snapshot(self) -> Dict[str, float]:
+        return {
+            "count": self._count,
+            "sum": self._sum,
+            "max": self._max,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+        }
+
+
+class Exporter(object):
+    """
+    Receives the snapshots of a `MetricsRegistry`. Subclasses push them to a concrete backend.
+    """
+
+    def export(self, snapshot: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+
+class JsonFileExporter(Exporter):
+    """
+    Writes every snapshot to a json file, replacing the previous one atomically.
+    """
+
+    def __init__(self, file_path: str):
+        self._file_path: str = file_path
+
+    def export(self, snapshot: Dict[str, Any]) -> None:
+        temp_path = f"{self._file_path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, indent=2)
+        os.replace(temp_path, self._file_path)
+
+
+class LogExporter(Exporter):
+    """
+    Logs every snapshot as a single json line.
+    """
+
+    def __init__(self, logger: logging.Logger, level: int = logging.INFO):
+        self._logger: logging.Logger = logger
+        self._level: int = level
+
+    def export(self, snapshot: Dict[str, Any]) -> None:
+        self._logger.log(self._level, "metrics %s", json.dumps(snapshot))
+
+
+class MetricsRegistry(object):
+    """
+    Holds the named counters, histograms and gauges of the plugin and hands their snapshots to the exporters.
+    """
+
+    def __init__(self):
+        self._counters: Dict[str, Counter] = {}
+        self._histograms: Dict[str, Histogram] = {}
+        self._gauges: Dict[str, Callable[[], float]] = {}
+        self._exporters: List[Exporter] = []
+        self._lock = threading.Lock()
+
+    def counter(self, name: str) -> Counter:
+        with self._lock:
+            counter = self._counters.get(name)
+            if counter is None:
+                counter = self._counters[name] = Counter()
+            return counter
+
+    def histogram(self, name: str, bounds: Sequence[float] = Histogram.DEFAULT_BOUNDS) -> Histogram:
+        """
+        Returns the histogram of the given name, creating it with the given bounds if it does not exist yet.
+        """
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram(bounds)
+            return histogram
+
+    def gauge(self, name: str, read: Callable[[], float]) -> None:
+        """
+        Registers a value that is read when a snapshot is taken, replacing a previous gauge of the same name.
+        """
+        with self._lock:
+            self._gauges[name] = read
+
+    @contextmanager
+    def timer(self, name: str):
+        """
+        Observes the duration of the block in seconds in the histogram of the given name, also when it raises.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.histogram(name).observe(time.perf_counter() - start)
+
+    def add_exporter(self, exporter: Exporter) -> None:
+        with self._lock:
+            self._exporters.append(exporter)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = dict(self._histograms)
+            gauges = dict(self._gauges)
+        values: Dict[str, Any] = {name: counter.value for name, counter in counters.items()}
+        values.update((name, histogram.snapshot()) for name, histogram in histograms.items())
+        for name, read in gauges.items():
+            try:
+                values[name] = read()
+            except Exception:
+                continue
+        return {"time": time.time(), "metrics": values}
+
+    def export(self) -> None:
+        """
+        Hands a snapshot to every exporter. A failing exporter does not keep the others from running.
+        """
+        snapshot = self.snapshot()
+        with self._lock:
+            exporters = list(self._exporters)
+        for exporter in exporters:
+            try:
+                exporter.export(snapshot)
+            except Exception as e:
+                logger.warning("metrics exporter %s failed: %s", type(exporter).__name__, e)
+
+    def render(self) -> str:
+        """
+        Renders a short human readable summary, durations in milliseconds.
+        """
+        lines = []
+        for name, value in sorted(self.snapshot()["metrics"].items()):
+            if isinstance(value, dict):
+                scale = 1000 if name.endswith("_seconds") else 1
+                unit = "ms" if scale == 1000 else ""
+                lines.append(
+                    f"{name.replace('_seconds', '')}: n={value['count']} "
+                    f"p50={value['p50'] * scale:.0f}{unit} p90={value['p90'] * scale:.0f}{unit} "
+                    f"max={value['max'] * scale:.0f}{unit}"
+                )
+            else:
+                lines.append(f"{name}: {value:g}")
+        return "\n".join(lines)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Drops repetitions of a log message, identified by its format string, within ``interval`` seconds.
+
+    The number of dropped repetitions is appended to the next record of the same message that passes.
+    """
+
+    def __init__(self, interval: float = 5.0):
+        super().__init__()
+        self._interval: float = interval
+        self._last: Dict[Tuple[str, int], Tuple[float, int]] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = (str(record.msg), record.levelno)
+        now = time.monotonic()
+        with self._lock:
+            last, dropped = self._last.get(key, (0.0, 0))
+            if now - last < self._interval:
+                self._last[key] = (last, dropped + 1)
+                return False
+            self._last[key] = (now, 0)
+        if dropped:
+            record.msg = f"{record.msg} (+{dropped} suppressed)"
+        return True
+
+
+# sizes from 1 KiB to 64 MiB and qualities in steps of ten
+SIZE_BOUNDS: Tuple[float, ...] = tuple(float(1024 << shift) for shift in range(17))
+QUALITY_BOUNDS: Tuple[float, ...] = tuple(float(q) for q in range(10, 101, 10))
+
+logger = logging.getLogger("PicEval")
+logger.addFilter(RateLimitFilter())
+if not logger.handlers:
+    # the host does not configure the standard logging, without a handler of its own nothing below WARNING shows
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(asctime)s | %(levelname)s | %(name)s - %(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+metrics = MetricsRegistry()
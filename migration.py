@@ -0,0 +1,259 @@
+import json
+import math
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Callable, Tuple, Set
+
+LEVEL_PATTERN = re.compile(r"^level(\d+)$")
+RESOLUTION_MARKER = ".level_resolution"
+
+
+def read_resolution(store_dir_path: str) -> Optional[int]:
+    """
+    Tells the level resolution the store is laid out for.
+
+    The resolution is read from the marker file that `Evaluate` writes, or inferred from the highest ``levelN``
+    dir for stores that predate the marker, since `Evaluate` always creates every level dir.
+
+    Returns:
+        Optional[int]: The resolution, or None for an empty store.
+
+    Raises:
+        FileExistsError: If the store holds a dir that is not a level dir.
+    """
+    marker_path = os.path.join(store_dir_path, RESOLUTION_MARKER)
+    if os.path.exists(marker_path):
+        with open(marker_path, "r", encoding="utf-8") as f:
+            return int(f.read().strip())
+    levels = []
+    with os.scandir(store_dir_path) as it:
+        for entry in it:
+            if not entry.is_dir():
+                continue
+            matched = LEVEL_PATTERN.match(entry.name)
+            if matched is None:
+                raise FileExistsError(f"store dir have incorrect content: {entry.name}")
+            levels.append(int(matched.group(1)))
+    return max(levels) if levels else None
+
+
+def write_resolution(store_dir_path: str, resolution: int) -> None:
+    marker_path = os.path.join(store_dir_path, RESOLUTION_MARKER)
+    with open(f"{marker_path}.tmp", "w", encoding="utf-8") as f:
+        f.write(str(resolution))
+    os.replace(f"{marker_path}.tmp", marker_path)
+
+
+def remap_level(level: int, old_resolution: int, new_resolution: int) -> int:
+    """
+    Maps a level to the new resolution, keeping its relative rank: ``ceil(level * new / old)``.
+    """
+    return min(new_resolution, max(1, math.ceil(level * new_resolution / old_resolution)))
+
+
+class StoreMigration(object):
+    """
+    Re-levels the store from one level resolution to another.
+
+    The old level dirs are first renamed into a staging dir inside the store, which frees their names and keeps
+    every later move on the same file system. Then one worker per new level moves the files of the old levels that
+    map to it, so no two workers ever pick names in the same dir. Every batch of renames is written to a journal
+    before it is carried out, and a migration that was interrupted is finished from the journal on the next start.
+    Finally the score ledger is rewritten with the new paths and scores.
+    """
+
+    STAGING_DIR = ".migrate"
+    JOURNAL = ".migrate.journal"
+    LEVEL_PREFIX = "level"
+
+    def __init__(
+        self,
+        store_dir_path: str,
+        new_resolution: int,
+        ledger_name: str = "scores.jsonl",
+        workers: int = 4,
+        batch_size: int = 512,
+        progress: Optional[Callable[[int, int], None]] = None,
+    ):
+        """
+        Initializes the StoreMigration.
+
+        Args:
+            store_dir_path (str): The store dir.
+            new_resolution (int): The level resolution to migrate to.
+            ledger_name (str, optional): The name of the score ledger in the store. Defaults to "scores.jsonl".
+            workers (int, optional): The number of new levels filled in parallel. Defaults to 4.
+            batch_size (int, optional): The number of renames journaled at once. Defaults to 512.
+            progress (Callable[[int, int], None], optional): Called with the moved and total count of files.
+        """
+        self._store_dir_path: str = store_dir_path
+        self._new_resolution: int = new_resolution
+        self._ledger_path: str = os.path.join(store_dir_path, ledger_name)
+        self._staging_path: str = os.path.join(store_dir_path, self.STAGING_DIR)
+        self._journal_path: str = os.path.join(store_dir_path, self.JOURNAL)
+        self._workers: int = workers
+        self._batch_size: int = batch_size
+        self._progress: Optional[Callable[[int, int], None]] = progress
+        self._lock = threading.Lock()
+        self._moved: int = 0
+        self._total: int = 0
+
+    def _level_dir(self, level: int) -> str:
+        return os.path.join(self._store_dir_path, f"{self.LEVEL_PREFIX}{level}")
+
+    @property
+    def pending(self) -> bool:
+        """
+        Tells whether an interrupted migration waits to be finished.
+        """
+        return os.path.exists(self._journal_path)
+
+    def needed(self) -> bool:
+        """
+        Tells whether the store is laid out for another resolution, or an interrupted migration waits.
+        """
+        if self.pending:
+            return True
+        old_resolution = read_resolution(self._store_dir_path)
+        return old_resolution is not None and old_resolution != self._new_resolution
+
+    def run(self) -> Tuple[int, int]:
+        """
+        Migrates the store, finishing an interrupted migration first.
+
+        Returns:
+            Tuple[int, int]: The old resolution and the number of moved files.
+        """
+        while True:
+            if self.pending:
+                begin, renames, phases = self._read_journal()
+                old_resolution, new_resolution = begin["old"], begin["new"]
+            else:
+                old_resolution = read_resolution(self._store_dir_path)
+                new_resolution = self._new_resolution
+                if old_resolution is None or old_resolution == new_resolution:
+                    return new_resolution, self._moved
+                renames, phases = {}, set()
+                self._append([{"op": "begin", "old": old_resolution, "new": new_resolution}])
+            if "staged" not in phases:
+                self._stage(old_resolution)
+                self._append([{"op": "staged"}])
+            if "moved" not in phases:
+                self._move_all(old_resolution, new_resolution, renames)
+                self._append([{"op": "moved"}])
+            if "ledger" not in phases:
+                self._rewrite_ledger(old_resolution, new_resolution, renames)
+                self._append([{"op": "ledger"}])
+            write_resolution(self._store_dir_path, new_resolution)
+            os.remove(self._journal_path)
+            if new_resolution == self._new_resolution:
+                return old_resolution, self._moved
+
+    def _append(self, records: List[dict]) -> None:
+        with self._lock, open(self._journal_path, "a", encoding="utf-8") as f:
+            f.writelines(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _read_journal(self) -> Tuple[dict, Dict[str, str], Set[str]]:
+        begin: dict = {}
+        renames: Dict[str, str] = {}
+        phases: Set[str] = set()
+        with open(self._journal_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record["op"] == "begin":
+                    begin = record
+                elif record["op"] == "move":
+                    renames.update(record["renames"])
+                else:
+                    phases.add(record["op"])
+        return begin, renames, phases
+
+    def _stage(self, old_resolution: int) -> None:
+        os.makedirs(self._staging_path, exist_ok=True)
+        for level in range(1, old_resolution + 1):
+            if os.path.isdir(self._level_dir(level)):
+                os.rename(self._level_dir(level), os.path.join(self._staging_path, f"{self.LEVEL_PREFIX}{level}"))
+
+    def _move_all(self, old_resolution: int, new_resolution: int, renames: Dict[str, str]) -> None:
+        # the renames journaled before an interruption are carried out first, they may not have happened yet
+        for source, target in renames.items():
+            if os.path.exists(source) and not os.path.exists(target):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.rename(source, target)
+        sources: Dict[int, List[str]] = {}
+        for level in range(1, old_resolution + 1):
+            staged = os.path.join(self._staging_path, f"{self.LEVEL_PREFIX}{level}")
+            if os.path.isdir(staged):
+                sources.setdefault(remap_level(level, old_resolution, new_resolution), []).append(staged)
+        self._total = sum(len(os.listdir(staged)) for staged_dirs in sources.values() for staged in staged_dirs)
+        self._moved = 0
+        for level in range(1, new_resolution + 1):
+            os.makedirs(self._level_dir(level), exist_ok=True)
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            jobs = [
+                executor.submit(self._fill_level, level, staged_dirs, renames)
+                for level, staged_dirs in sources.items()
+            ]
+            for job in jobs:
+                job.result()
+        for staged_dirs in sources.values():
+            for staged in staged_dirs:
+                os.rmdir(staged)
+        if os.path.isdir(self._staging_path):
+            os.rmdir(self._staging_path)
+
+    def _fill_level(self, level: int, staged_dirs: List[str], renames: Dict[str, str]) -> None:
+        target_dir = self._level_dir(level)
+        taken = set(os.listdir(target_dir))
+        for staged in staged_dirs:
+            names = os.listdir(staged)
+            for start in range(0, len(names), self._batch_size):
+                batch: Dict[str, str] = {}
+                for name in names[start : start + self._batch_size]:
+                    stem, ext = os.path.splitext(name)
+                    target_name = name
+                    suffix = 0
+                    while target_name in taken:
+                        suffix += 1
+                        target_name = f"{stem}_{suffix}{ext}"
+                    taken.add(target_name)
+                    batch[os.path.join(staged, name)] = os.path.join(target_dir, target_name)
+                self._append([{"op": "move", "renames": batch}])
+                for source, target in batch.items():
+                    os.rename(source, target)
+                with self._lock:
+                    renames.update(batch)
+                    self._moved += len(batch)
+                    moved = self._moved
+                if self._progress:
+                    self._progress(moved, self._total)
+
+    def _rewrite_ledger(self, old_resolution: int, new_resolution: int, renames: Dict[str, str]) -> None:
+        if not os.path.exists(self._ledger_path):
+            return
+        # the ledger holds the paths the files had before they were staged
+        by_old_path: Dict[str, str] = {}
+        staging_prefix = os.path.join(self._staging_path, "")
+        for source, target in renames.items():
+            by_old_path[os.path.join(self._store_dir_path, source[len(staging_prefix) :])] = target
+        temp_path = f"{self._ledger_path}.tmp"
+        with open(self._ledger_path, "r", encoding="utf-8") as src, open(temp_path, "w", encoding="utf-8") as dst:
+            for line in src:
+                try:
+                    timestamp, score, path, source = json.loads(line)
+                except ValueError:
+                    continue
+                path = by_old_path.get(path, path)
+                if score is not None:
+                    score = remap_level(score, old_resolution, new_resolution)
+                dst.write(json.dumps([timestamp, score, path, source], ensure_ascii=False) + "\n")
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(temp_path, self._ledger_path)
@@ -0,0 +1,127 @@
+import asyncio
+import os
+from collections import deque
+from typing import Callable, Awaitable, Optional, Tuple, AsyncIterator, Deque, Set
+
+from .compressor import CompressorBusy
+from .metrics import logger
+
+
+class PicturePipeline(object):
+    """
+    Selects and compresses pictures ahead of their upload.
+
+    A batch keeps up to ``prefetch`` pictures in compression while the ready ones are uploaded, so the batch takes
+    about one compression plus the uploads instead of the sum of both. A warm pool of ``warm_size`` pictures
+    compressed in advance answers the first pictures of a request without any compression at all. Pictures in the
+    warm pool are drawn without a group, so per-group strategies do not apply to them.
+    """
+
+    def __init__(
+        self,
+        select: Callable[[Optional[int]], str],
+        compress: Callable[[str], Awaitable[str]],
+        prefetch: int = 2,
+        warm_size: int = 0,
+        refill_interval: float = 5.0,
+    ):
+        """
+        Initializes the PicturePipeline.
+
+        Args:
+            select (Callable[[Optional[int]], str]): Selects a picture for the given group.
+            compress (Callable[[str], Awaitable[str]]): Compresses a picture and returns the path of the output.
+            prefetch (int, optional): The number of pictures of a batch compressed ahead. Defaults to 2.
+            warm_size (int, optional): The number of pictures kept compressed in advance. Defaults to 0.
+            refill_interval (float, optional): The pause in seconds between two refills of the warm pool.
+        """
+        self._select: Callable[[Optional[int]], str] = select
+        self._compress: Callable[[str], Awaitable[str]] = compress
+        self._prefetch: int = max(1, prefetch)
+        self._warm_size: int = warm_size
+        self._refill_interval: float = refill_interval
+        self._warm: Deque[Tuple[str, str]] = deque()
+
+    @property
+    def warm_count(self) -> int:
+        return len(self._warm)
+
+    async def _produce(self, group: Optional[int]) -> Tuple[str, str]:
+        picture = self._select(group)
+        return picture, await self._compress(picture)
+
+    def _take_warm(self) -> Optional[Tuple[str, str]]:
+        while self._warm:
+            picture, output_path = self._warm.popleft()
+            if os.path.exists(picture) and os.path.exists(output_path):
+                return picture, output_path
+        return None
+
+    async def stream(self, count: int, group: Optional[int] = None) -> AsyncIterator[Tuple[str, str]]:
+        """
+        Yields ``count`` pictures and their compressed outputs, each as soon as it is ready.
+
+        Args:
+            count (int): The number of pictures.
+            group (int, optional): The group the pictures are selected for.
+
+        Yields:
+            Tuple[str, str]: The path of a picture and the path of its compressed output.
+
+        Raises:
+            CompressorBusy: If the compressor rejected a picture, after the pictures that were ready.
+        """
+        remaining = count
+        while remaining:
+            warm = self._take_warm()
+            if warm is None:
+                break
+            remaining -= 1
+            yield warm
+
+        running: Set[asyncio.Future] = set()
+        busy: Optional[CompressorBusy] = None
+        try:
+            while True:
+                while remaining and len(running) < self._prefetch and busy is None:
+                    running.add(asyncio.ensure_future(self._produce(group)))
+                    remaining -= 1
+                if not running:
+                    break
+                done = next((job for job in running if job.done()), None)
+                if done is None:
+                    await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                    continue
+                running.discard(done)
+                try:
+                    result = done.result()
+                except CompressorBusy as e:
+                    busy = e
+                    continue
+                # the next compression starts before this picture is handed out for upload
+                while remaining and len(running) < self._prefetch and busy is None:
+                    running.add(asyncio.ensure_future(self._produce(group)))
+                    remaining -= 1
+                yield result
+        finally:
+            for job in running:
+                job.cancel()
+        if busy is not None:
+            raise busy
+
+    async def keep_warm(self) -> None:
+        """
+        Refills the warm pool forever. Does nothing if the warm pool is disabled.
+        """
+        if self._warm_size <= 0:
+            return
+        while True:
+            if len(self._warm) < self._warm_size:
+                try:
+                    self._warm.append(await self._produce(None))
+                except (CompressorBusy, FileNotFoundError):
+                    pass
+                except Exception as e:
+                    # a picture that can not be compressed must not stop the refills
+                    logger.warning("failed to refill the warm pool: %s", e)
+            await asyncio.sleep(self._refill_interval)
@@ -0,0 +1,246 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Dict, Optional, Tuple
+
+
+class ScoreRecord(object):
+    """
+    The score of one file of the store.
+    """
+
+    __slots__ = ("path", "score", "timestamp", "source")
+
+    def __init__(self, path: str, score: int, timestamp: float, source: Optional[str] = None):
+        self.path: str = path
+        self.score: int = score
+        self.timestamp: float = timestamp
+        self.source: Optional[str] = source
+
+    @property
+    def source_dir(self) -> Optional[str]:
+        return os.path.dirname(self.source) if self.source else None
+
+    def __repr__(self) -> str:
+        return f"ScoreRecord({self.path!r}, {self.score!r}, {self.timestamp!r}, {self.source!r})"
+
+
+class ScoreIndex(object):
+    """
+    An in-memory index of the scores of the store, persisted by the score ledger.
+
+    Every mark appends ``[time, score, path, source]`` to the ledger and a removal appends ``[time, null, path,
+    null]``; loading replays the ledger, so the store itself is only walked by `reconcile`. Scores are small ints,
+    so the records are kept in one bucket per score, ordered by the time they were marked. A top-k or range query
+    thus costs O(levels + k), and the counts per level and per source dir are kept up to date on every change.
+    """
+
+    def __init__(self, ledger_path: str, store_dir_path: str, level_dirs: List[str]):
+        """
+        Initializes the ScoreIndex and replays the ledger.
+
+        Args:
+            ledger_path (str): The path of the score ledger.
+            store_dir_path (str): The store dir, holding one dir per level.
+            level_dirs (List[str]): The names of the level dirs, the n-th one holds the files scored n + 1.
+        """
+        self._ledger_path: str = ledger_path
+        self._store_dir_path: str = store_dir_path
+        self._level_dirs: List[str] = level_dirs
+        self._records: Dict[str, ScoreRecord] = {}
+        self._levels: Dict[int, "OrderedDict[str, ScoreRecord]"] = {}
+        self._sources: Dict[str, ScoreRecord] = {}
+        self._dir_stats: Dict[Optional[str], List[int]] = {}
+        self._total: int = 0
+        self._lock = threading.RLock()
+        self.load()
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def __contains__(self, path: str) -> bool:
+        return path in self._records
+
+    def get(self, path: str) -> Optional[ScoreRecord]:
+        return self._records.get(path)
+
+    def _insert(self, record: ScoreRecord) -> None:
+        self._remove(record.path)
+        self._records[record.path] = record
+        self._levels.setdefault(record.score, OrderedDict())[record.path] = record
+        stats = self._dir_stats.setdefault(record.source_dir, [0, 0])
+        stats[0] += 1
+        stats[1] += record.score
+        self._total += record.score
+        if record.source:
+            self._sources[record.source] = record
+
+    def _remove(self, path: str) -> Optional[ScoreRecord]:
+        record = self._records.pop(path, None)
+        if record is None:
+            return None
+        del self._levels[record.score][path]
+        stats = self._dir_stats[record.source_dir]
+        stats[0] -= 1
+        stats[1] -= record.score
+        if not stats[0]:
+            del self._dir_stats[record.source_dir]
+        self._total -= record.score
+        return record
+
+    def _write(self, lines: List[list]) -> None:
+        with open(self._ledger_path, "a", encoding="utf-8") as f:
+            f.writelines(json.dumps(line, ensure_ascii=False) + "\n" for line in lines)
+
+    def add(
+        self, path: str, score: int, source: Optional[str] = None, timestamp: Optional[float] = None
+    ) -> ScoreRecord:
+        """
+        Records the score of a file, replacing its previous score, and appends it to the ledger.
+
+        Args:
+            path (str): The path of the file in the store.
+            score (int): The score of the file.
+            source (str, optional): The asset the file is a copy of, if known.
+            timestamp (float, optional): The time of the mark. Defaults to now.
+
+        Returns:
+            ScoreRecord: The new record.
+        """
+        record = ScoreRecord(path, score, time.time() if timestamp is None else timestamp, source)
+        with self._lock:
+            self._write([[record.timestamp, score, path, source]])
+            self._insert(record)
+        return record
+
+    def discard(self, path: str) -> bool:
+        """
+        Forgets the score of a file, appending the removal to the ledger.
+
+        Returns:
+            bool: True if the file was indexed.
+        """
+        with self._lock:
+            if path not in self._records:
+                return False
+            self._write([[time.time(), None, path, None]])
+            self._remove(path)
+            return True
+
+    def top(self, k: int, low: Optional[int] = None, high: Optional[int] = None) -> List[ScoreRecord]:
+        """
+        Returns the best scored files, the most recently marked first among equal scores.
+
+        Args:
+            k (int): The maximal number of records.
+            low (int, optional): The lowest score included.
+            high (int, optional): The highest score included.
+
+        Returns:
+            List[ScoreRecord]: The records, best first.
+        """
+        found: List[ScoreRecord] = []
+        with self._lock:
+            for score in sorted(self._levels, reverse=True):
+                if (high is not None and score > high) or (low is not None and score < low):
+                    continue
+                for path in reversed(self._levels[score]):
+                    if len(found) >= k:
+                        return found
+                    found.append(self._levels[score][path])
+        return found
+
+    def count(self, low: Optional[int] = None, high: Optional[int] = None) -> int:
+        """
+        Counts the files whose score lies in the range, both ends included.
+        """
+        with self._lock:
+            return sum(
+                len(bucket)
+                for score, bucket in self._levels.items()
+                if (low is None or score >= low) and (high is None or score <= high)
+            )
+
+    def level_counts(self) -> Dict[int, int]:
+        with self._lock:
+            return {score: len(bucket) for score, bucket in sorted(self._levels.items()) if bucket}
+
+    @property
+    def mean(self) -> float:
+        return self._total / len(self._records) if self._records else 0.0
+
+    def dir_stats(self) -> Dict[Optional[str], Tuple[int, float]]:
+        """
+        Returns the number of scored files and their mean score per source asset dir, None for unknown sources.
+        """
+        with self._lock:
+            return {source_dir: (count, total / count) for source_dir, (count, total) in self._dir_stats.items()}
+
+    def source_scores(self) -> Dict[str, int]:
+        """
+        Returns the latest score of every asset that was marked with a known source and is still in the store.
+        """
+        with self._lock:
+            return {
+                source: record.score
+                for source, record in self._sources.items()
+                if self._records.get(record.path) is record
+            }
+
+    def load(self) -> None:
+        """
+        Replays the ledger. Lines that can not be parsed, such as a torn last line, are skipped.
+        """
+        if not os.path.exists(self._ledger_path):
+            return
+        with self._lock, open(self._ledger_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    timestamp, score, path, source = json.loads(line)
+                except ValueError:
+                    continue
+                if score is None:
+                    self._remove(path)
+                else:
+                    self._insert(ScoreRecord(path, score, timestamp, source))
+
+    def reconcile(self) -> Tuple[int, int]:
+        """
+        Walks the level dirs of the store, indexing the files that are missing from the ledger, such as files
+        stored before the ledger existed, and forgetting the files that are gone.
+
+        Returns:
+            Tuple[int, int]: The number of added and dropped files.
+        """
+        started = time.time()
+        found: List[Tuple[float, str, int]] = []
+        for score, level_dir in enumerate(self._level_dirs, start=1):
+            level_path = f"{self._store_dir_path}/{level_dir}"
+            if not os.path.isdir(level_path):
+                continue
+            with os.scandir(level_path) as it:
+                for entry in it:
+                    if entry.is_file():
+                        found.append((entry.stat().st_mtime, f"{level_path}/{entry.name}", score))
+        existing = {path for _, path, _ in found}
+        found.sort()
+        with self._lock:
+            # files marked during the walk may have been missed by it
+            gone = [
+                path
+                for path, record in self._records.items()
+                if path not in existing and record.timestamp < started
+            ]
+            fresh = [(timestamp, path, score) for timestamp, path, score in found if path not in self._records]
+            now = time.time()
+            lines = [[now, None, path, None] for path in gone]
+            lines += [[timestamp, score, path, None] for timestamp, path, score in fresh]
+            if lines:
+                self._write(lines)
+            for path in gone:
+                self._remove(path)
+            for timestamp, path, score in fresh:
+                self._insert(ScoreRecord(path, score, timestamp))
+        return len(fresh), len(gone)
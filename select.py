@@ -1,67 +1,66 @@
 import hashlib
-import hmac
 import os
-import pickle
+import threading
+import time
 import warnings
-from random import choice
-from typing import List, Any, Sequence
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from random import random
+from typing import List, Sequence, Optional, Callable, Iterable, Tuple, Dict
 
-from modules.file_manager import explore_folder
+from .file_index import FileIndex
+from .metrics import metrics
+from .strategies import SelectStrategy
 
 
-def sign_and_pickle(data: Any, key: bytes, file_path: str):
+def shard_file_name(root: str) -> str:
     """
-    Sign and pickle the given data using the provided key, and save it to the specified file path.
-
-    Parameters:
-        data (Any): The data to be pickled.
-        key (bytes): The key to be used for signing.
-        file_path (str): The path of the file to save the pickled data and signature.
-
-    Returns:
-        None
+    Returns the name of the index file of the shard of an asset root, derived from its absolute path.
     """
-    pickled_data = pickle.dumps(data)
-    signature = hmac.new(key, pickled_data, hashlib.sha256).digest()
-    with open(file_path, "wb") as f:
-        f.write(pickled_data + signature)
+    return f"{hashlib.sha1(os.path.abspath(root).encode('utf-8', 'surrogateescape')).hexdigest()[:16]}.idx"
 
 
-def unpickle_and_verify(file_path: str, key: bytes) -> Any:
+def _build_shard(root: str, ignore_dirs: Sequence[str], index_path: str, key: bytes) -> Tuple[int, int]:
     """
-    Unpickle and verify a pickled object from a file.
-
-    This function takes a file path and a key as input. It reads the file using
-    the given file path and unpickles the data. The function then verifies the
-    integrity of the data using a signature calculated with the given key. If
-    the signature is valid, the function returns the unpickled object. Otherwise,
-    it raises a ValueError with the message "Invalid signature".
-
-    Parameters:
-        file_path (str): The path of the file to read the pickled data and signature.
-        key (bytes): The key used for signing the data.
+    Loads the shard of one root, refreshes it and saves it if it changed. Runs in a worker process.
 
     Returns:
-        Any: The unpickled object.
-
+        Tuple[int, int]: The number of added and removed entries.
     """
-    with open(file_path, "rb") as file:
-        pickled_data = file.read()
-        data = pickled_data[:-32]
-        signature = pickled_data[-32:]
-        calculated_signature = hmac.new(key, data, hashlib.sha256).digest()
-        if not hmac.compare_digest(signature, calculated_signature):
-            warnings.warn(f"Invalid signature of pickle at {file_path}")
-            return None
-
-        return pickle.loads(data)
+    file_index = FileIndex.load(file_path=index_path, key=key) if os.path.exists(index_path) else None
+    if file_index is None or not file_index.matches([root], ignore_dirs):
+        file_index = FileIndex([root], ignore_dirs)
+    added, removed = file_index.refresh()
+    if file_index.dirty:
+        file_index.dump(file_path=index_path, key=key)
+    return added, removed
 
 
 class Selector(object):
-    __cache_file = "file_index_cache.pkl"
+    """
+    Draws random files from a set of asset roots.
+
+    Every root is indexed by a `FileIndex` shard of its own, persisted to its own file below the cache dir, so
+    adding, removing or rescanning a root never touches the others. The shards are loaded and refreshed in parallel
+    worker processes at startup. A draw first picks a shard by the weight of its root, then a file within the shard
+    by the strategy, so a huge root does not drown out the small ones.
+    """
+
+    __cache_file = "file_index.idx"
+    __legacy_cache_file = "file_index_cache.pkl"
+    __shard_dir = "shards"
     __PICKLE_KEY = b"asdjnbskjdvlbkjb"
 
-    def __init__(self, asset_dirs: List[str], cache_dir: str, ignore_dirs: Sequence[str] = tuple()):
+    def __init__(
+        self,
+        asset_dirs: List[str],
+        cache_dir: str,
+        ignore_dirs: Sequence[str] = tuple(),
+        persist_interval: float = 60.0,
+        strategy: Optional[SelectStrategy] = None,
+        weights: Optional[Dict[str, float]] = None,
+        workers: Optional[int] = None,
+    ):
         """
         Initializes the Selector object.
 
@@ -69,40 +68,81 @@ class Selector(object):
             asset_dirs (str): The directory path containing the assets.
             cache_dir (str): The directory path to store the cache.
             ignore_dirs (Sequence[str], optional): A sequence of directory names to ignore. Defaults to an empty tuple.
+            persist_interval (float, optional): The minimal interval in seconds between two saves of the index
+                caused by dropped entries. Defaults to 60.
+            strategy (SelectStrategy, optional): The strategy files are drawn with. Defaults to uniform draws.
+            weights (Dict[str, float], optional): The weight of a shard by asset root, the roots not listed weigh
+                1. A root weighing 0 is never drawn from.
+            workers (int, optional): The number of processes the shards are built in. Defaults to the cpu count.
 
         Raises:
             FileNotFoundError: If the asset_dir does not exist.
-            FileNotFoundError: If the file_index is empty after updating.
         """
 
         if not all(os.path.exists(asset_dir) for asset_dir in asset_dirs):
             raise FileNotFoundError("some asset_dir not exists")
         self._asset_dir: List[str] = asset_dirs
         self._cache_dir: str = cache_dir
-        os.makedirs(self._cache_dir, exist_ok=True)
+        self._shard_dir: str = f"{cache_dir}/{self.__shard_dir}"
+        os.makedirs(self._shard_dir, exist_ok=True)
         self._ignore_dirs: Sequence[str] = ignore_dirs
-        self._file_index: List[str] = []
-        if os.path.exists(f"{self._cache_dir}/{self.__cache_file}"):
-            self._file_index: List[str] = unpickle_and_verify(
-                file_path=f"{self._cache_dir}/{self.__cache_file}", key=self.__PICKLE_KEY
-            )
+        self._persist_interval: float = persist_interval
+        self._last_persist: float = 0.0
+        self._persisting: bool = False
+        self._strategy: SelectStrategy = strategy or SelectStrategy()
+        self._strategy.bind(asset_dirs)
+        weights = weights or {}
+        self._weights: Dict[str, float] = {root: float(weights.get(root, 1.0)) for root in asset_dirs}
+        self._lock = threading.RLock()
+        self._scan_lock = threading.Lock()
+
+        for legacy_file in (self.__legacy_cache_file, self.__cache_file):
+            if os.path.exists(f"{self._cache_dir}/{legacy_file}"):
+                os.remove(f"{self._cache_dir}/{legacy_file}")
+        self._shards: Dict[str, FileIndex] = {}
+        self._load_shards(workers or os.cpu_count() or 1)
 
-        if self._file_index:
-            temp = self._file_index[0]
-            if all(asset_dir not in temp for asset_dir in asset_dirs):
-                self._update_index()
-        else:
-            self._update_index()
+        print(f"Found {self.asset_size} files in {len(self._shards)} shards")
 
-        print(f"Found {len(self._file_index)} files")
+    def _shard_path(self, root: str) -> str:
+        return f"{self._shard_dir}/{shard_file_name(root)}"
+
+    def _load_shards(self, workers: int) -> None:
+        """
+        Builds or refreshes every shard in a process pool, then maps the saved shards.
+
+        Shard files of roots that are no longer configured are removed.
+        """
+        jobs = [(root, self._ignore_dirs, self._shard_path(root), self.__PICKLE_KEY) for root in self._asset_dir]
+        built = False
+        if workers > 1 and len(jobs) > 1:
+            try:
+                with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+                    list(executor.map(_build_shard, *zip(*jobs)))
+                built = True
+            except (OSError, BrokenProcessPool) as e:
+                warnings.warn(f"Failed to build the shards in parallel, building them in turn: {e}")
+        if not built:
+            for job in jobs:
+                _build_shard(*job)
+        for root in self._asset_dir:
+            file_index = FileIndex.load(file_path=self._shard_path(root), key=self.__PICKLE_KEY)
+            if file_index is None:
+                file_index = FileIndex([root], self._ignore_dirs)
+                file_index.refresh()
+            self._shards[root] = file_index
+
+        kept = {shard_file_name(root) for root in self._asset_dir}
+        for name in os.listdir(self._shard_dir):
+            if name.endswith(".idx") and name not in kept:
+                os.remove(f"{self._shard_dir}/{name}")
 
     def _update_index(self):
         """
         Updates the index of files in the class instance.
 
-        This function retrieves all the files in the specified asset directories and updates the file index accordingly.
-        The function uses the `explore_folder` function to explore each asset directory and retrieve the list of files.
-        The retrieved lists are then concatenated to form the complete file index.
+        Only the directories whose mtime changed since the last scan are listed again, see `FileIndex.refresh`.
+        The index is persisted if anything changed.
 
         Parameters:
             None
@@ -110,33 +150,163 @@ class Selector(object):
         Returns:
             None
         """
-        assets = [explore_folder(asset_dir, ignore_list=self._ignore_dirs) for asset_dir in self._asset_dir]
-        self._file_index: List[str] = []
-        for asset in assets:
-            self._file_index += asset
-        sign_and_pickle(
-            data=self._file_index, key=self.__PICKLE_KEY, file_path=f"{self._cache_dir}/{self.__cache_file}"
-        )
+        self.refresh()
+        self.persist(force=True)
 
-    def random_select(self) -> str:
+    def refresh(self, dir_paths: Optional[Iterable[str]] = None) -> Tuple[int, int]:
         """
-        Selects a random file from the file index.
+        Refreshes the index, or only the given directories of it, see `FileIndex.scan`.
+
+        Only the shards of the roots the given directories lie in are scanned. The file system is scanned without
+        holding the lock of the index, which is only taken to apply the changes, so draws from other threads are
+        not held up by the scan. This is safe to call from any thread.
+
+        Args:
+            dir_paths (Iterable[str], optional): The directories to refresh, the whole index if not given.
+
+        Returns:
+            Tuple[int, int]: The number of added and removed entries.
+        """
+        by_root: Dict[str, Optional[List[str]]] = {root: None for root in self._shards}
+        if dir_paths is not None:
+            by_root = {}
+            for dir_path in dir_paths:
+                for root in self._shards:
+                    if dir_path == root or dir_path.startswith(os.path.join(root, "")):
+                        by_root.setdefault(root, []).append(dir_path)
+        added = removed = 0
+        with self._scan_lock:
+            for root, shard_dir_paths in by_root.items():
+                delta = self._shards[root].scan(shard_dir_paths)
+                with self._lock:
+                    shard_added, shard_removed = self._shards[root].apply(delta)
+                added += shard_added
+                removed += shard_removed
+        return added, removed
+
+    def persist(self, force: bool = False):
+        """
+        Saves the dirty shards if the persist interval elapsed, or unconditionally if forced.
+
+        Only the entry tables of a shard are copied under the lock, the file is written outside it, so draws go on
+        meanwhile. The lock is taken again to re-map the shards that did not change since their copy, the others
+        stay dirty for the next save. Re-mapping rebuilds the directory records a scan reads, so no scan may run.
+        """
+        with self._scan_lock:
+            with self._lock:
+                dirty = [root for root, file_index in self._shards.items() if file_index.dirty]
+                if not dirty:
+                    return
+                now = time.monotonic()
+                if not force and now - self._last_persist < self._persist_interval:
+                    return
+                snapshots = [(root, self._shards[root].snapshot()) for root in dirty]
+            written = [
+                (root, snapshot, snapshot.write(file_path=self._shard_path(root), key=self.__PICKLE_KEY))
+                for root, snapshot in snapshots
+            ]
+            with self._lock:
+                for root, snapshot, temp_path in written:
+                    self._shards[root].adopt(snapshot, temp_path, self._shard_path(root))
+                self._last_persist = now
+
+    def _persist_later(self) -> None:
+        """
+        Saves the dirty shards from a background thread once the persist interval elapsed, see `persist`.
+        """
+        with self._lock:
+            if self._persisting or time.monotonic() - self._last_persist < self._persist_interval:
+                return
+            if not any(file_index.dirty for file_index in self._shards.values()):
+                return
+            self._persisting = True
+
+        def persist():
+            try:
+                self.persist()
+            finally:
+                with self._lock:
+                    self._persisting = False
+
+        threading.Thread(target=persist, name="PicEval-index-persist", daemon=True).start()
+
+    def dir_paths(self) -> List[str]:
+        """
+        Returns the paths of all indexed directories.
+        """
+        with self._lock:
+            return [dir_path for file_index in self._shards.values() for dir_path in file_index.dir_paths()]
+
+    @property
+    def strategy(self) -> SelectStrategy:
+        return self._strategy
+
+    def _pick_shard(self) -> Optional[FileIndex]:
+        candidates = [
+            (self._weights[root], file_index)
+            for root, file_index in self._shards.items()
+            if self._weights[root] > 0 and len(file_index)
+        ]
+        target = random() * sum(weight for weight, _ in candidates)
+        for weight, file_index in candidates:
+            target -= weight
+            if target < 0:
+                return file_index
+        return candidates[-1][1] if candidates else None
+
+    def random_select(
+        self, group: Optional[int] = None, skip: Optional[Callable[[str], bool]] = None, max_skips: int = 16
+    ) -> str:
+        """
+        Selects a random file, from a shard picked by weight, drawn by the strategy of the selector.
+
+        Entries whose file no longer exists are dropped from the index one at a time, the shards are saved later
+        from a background thread, so a draw never writes to disk.
+
+        Args:
+            group (int, optional): The group the file is selected for, used by per-group strategies.
+            skip (Callable[[str], bool], optional): Draws for which it returns True are redrawn, for example the
+                redundant near-duplicates of a `PHashIndex`.
+            max_skips (int, optional): The number of redraws after which a skipped file is returned anyway.
 
         Returns:
             str: The path of the selected file.
 
         Raises:
-            None.
+            FileNotFoundError: If the asset dirs contain no file at all.
         """
-        while True:
-            selected = choice(self._file_index)
-            if os.path.exists(selected):
-                return selected
-            else:
-                self._update_index()
-
-    # TODO imp more other selector
+        with metrics.timer("index_lookup_seconds"):
+            refreshed = False
+            skipped = 0
+            while True:
+                with self._lock:
+                    file_index = self._pick_shard()
+                    if file_index is not None:
+                        position, selected = self._strategy.draw(file_index, group)
+                if file_index is None:
+                    if refreshed:
+                        raise FileNotFoundError("no file found in the asset dirs")
+                    self._update_index()
+                    refreshed = True
+                    continue
+                if os.path.exists(selected):
+                    if skip is not None and skipped < max_skips and skip(selected):
+                        skipped += 1
+                        continue
+                    self._persist_later()
+                    return selected
+                with self._lock:
+                    self._strategy.discard(selected)
+                    if position is not None and position < len(file_index):
+                        if file_index.path_at(position) == selected:
+                            file_index.remove_at(position)
 
     @property
     def asset_size(self) -> int:
-        return len(self._file_index)
+        return sum(len(file_index) for file_index in self._shards.values())
+
+    def shard_sizes(self) -> Dict[str, int]:
+        """
+        Returns the number of indexed files by asset root.
+        """
+        return {root: len(file_index) for root, file_index in self._shards.items()}
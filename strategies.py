@@ -0,0 +1,253 @@
+import os
+from random import random, getrandbits
+from typing import List, Dict, Optional, Tuple, Callable, Sequence
+
+from .file_index import FileIndex
+
+
+class SelectStrategy(object):
+    """
+    Draws files from a `FileIndex`. The base strategy draws uniformly, the others refine it.
+
+    `draw` returns the position of the drawn entry, when the strategy knows it, together with its path, so that
+    the `Selector` can drop a missing entry from the index; `discard` tells the strategy about such a path.
+
+    The `Selector` keeps one index per asset root, draws go to the index of a single root, which `bind` announces.
+    """
+
+    def bind(self, roots: Sequence[str]) -> None:
+        """
+        Tells the strategy the asset roots of the shards it will draw from.
+        """
+
+    def draw(self, index: FileIndex, group: Optional[int] = None) -> Tuple[Optional[int], str]:
+        """
+        Draws a file.
+
+        Args:
+            index (FileIndex): The index to draw from, which must not be empty.
+            group (int, optional): The group the file is drawn for.
+
+        Returns:
+            Tuple[Optional[int], str]: The position of the file in the index, if known, and its path.
+        """
+        position = index.random_position()
+        return position, index.path_at(position)
+
+    def discard(self, path: str) -> None:
+        """
+        Forgets a drawn path whose file turned out to be missing.
+        """
+
+
+class FenwickTree(object):
+    """
+    A binary indexed tree of non-negative weights, with O(log n) updates and weighted draws.
+    """
+
+    def __init__(self):
+        self._tree: List[float] = [0.0]
+        self._weights: List[float] = []
+
+    def __len__(self) -> int:
+        return len(self._weights)
+
+    @property
+    def total(self) -> float:
+        return self.prefix_sum(len(self._weights))
+
+    def append(self, weight: float) -> int:
+        """
+        Appends a slot and returns its index.
+        """
+        slot = len(self._weights)
+        self._weights.append(0.0)
+        i = slot + 1
+        # the new node covers the range (i - lowbit(i), i], whose earlier part is already summed in the tree
+        self._tree.append(self.prefix_sum(slot) - self.prefix_sum(i - (i & -i)))
+        self.update(slot, weight)
+        return slot
+
+    def update(self, slot: int, weight: float) -> None:
+        delta = weight - self._weights[slot]
+        self._weights[slot] = weight
+        i = slot + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def prefix_sum(self, count: int) -> float:
+        total = 0.0
+        while count > 0:
+            total += self._tree[count]
+            count -= count & -count
+        return total
+
+    def find(self, value: float) -> int:
+        """
+        Returns the slot whose cumulative weight range contains the value.
+        """
+        slot = 0
+        step = 1 << (len(self._tree).bit_length())
+        while step:
+            nxt = slot + step
+            if nxt < len(self._tree) and self._tree[nxt] <= value:
+                slot = nxt
+                value -= self._tree[nxt]
+            step >>= 1
+        return min(slot, len(self._weights) - 1)
+
+
+class _ScoredBucket(object):
+    """
+    The weights of the scored files of one asset root.
+    """
+
+    __slots__ = ("tree", "slots", "paths", "free")
+
+    def __init__(self):
+        self.tree: FenwickTree = FenwickTree()
+        self.slots: Dict[str, int] = {}
+        self.paths: List[Optional[str]] = []
+        self.free: List[int] = []
+
+    def set(self, path: str, weight: float) -> None:
+        slot = self.slots.get(path)
+        if slot is not None:
+            self.tree.update(slot, weight)
+            return
+        if self.free:
+            slot = self.free.pop()
+            self.tree.update(slot, weight)
+            self.paths[slot] = path
+        else:
+            slot = self.tree.append(weight)
+            self.paths.append(path)
+        self.slots[path] = slot
+
+    def discard(self, path: str) -> None:
+        slot = self.slots.pop(path, None)
+        if slot is not None:
+            self.tree.update(slot, 0.0)
+            self.paths[slot] = None
+            self.free.append(slot)
+
+
+class ScoreWeightedStrategy(SelectStrategy):
+    """
+    Draws files with a weight derived from their past score.
+
+    Only scored files carry an explicit weight, kept in a `FenwickTree` per asset root; every other file weighs
+    ``base_weight``. A draw first picks the scored or the unscored mass of the shard, then either walks the tree of
+    its root or draws uniformly from the shard and redraws the scored hits, so nothing is materialised per indexed
+    file.
+    """
+
+    def __init__(self, weight_of: Callable[[int], float], base_weight: float = 1.0):
+        """
+        Initializes the ScoreWeightedStrategy.
+
+        Args:
+            weight_of (Callable[[int], float]): Maps a score to a weight.
+            base_weight (float, optional): The weight of a file without score. Defaults to 1.
+        """
+        self._weight_of: Callable[[int], float] = weight_of
+        self._base_weight: float = base_weight
+        self._roots: Tuple[str, ...] = ()
+        self._weights: Dict[str, float] = {}
+        self._buckets: Dict[Optional[str], _ScoredBucket] = {}
+
+    def _root_of(self, path: str) -> Optional[str]:
+        for root in self._roots:
+            if path.startswith(os.path.join(root, "")):
+                return root
+        return None
+
+    def bind(self, roots: Sequence[str]) -> None:
+        self._roots = tuple(roots)
+        self._buckets = {}
+        for path, weight in self._weights.items():
+            self._buckets.setdefault(self._root_of(path), _ScoredBucket()).set(path, weight)
+
+    def set_score(self, path: str, score: int) -> None:
+        """
+        Sets the score of a file in O(log n).
+        """
+        weight = max(0.0, self._weight_of(score))
+        self._weights[path] = weight
+        self._buckets.setdefault(self._root_of(path), _ScoredBucket()).set(path, weight)
+
+    def discard(self, path: str) -> None:
+        if self._weights.pop(path, None) is not None:
+            self._buckets[self._root_of(path)].discard(path)
+
+    def draw(self, index: FileIndex, group: Optional[int] = None) -> Tuple[Optional[int], str]:
+        roots = index.roots
+        bucket = self._buckets.get(roots[0] if len(roots) == 1 and roots[0] in self._roots else None)
+        if bucket is None:
+            return super().draw(index, group)
+        scored_mass = bucket.tree.total
+        unscored_mass = self._base_weight * max(0, len(index) - len(bucket.slots))
+        if scored_mass > 0 and random() * (scored_mass + unscored_mass) < scored_mass:
+            path = bucket.paths[bucket.tree.find(random() * scored_mass)]
+            if path is not None:
+                return None, path
+        for _ in range(16):
+            position, path = super().draw(index, group)
+            if path not in bucket.slots:
+                break
+        return position, path
+
+
+class _Cursor(object):
+    __slots__ = ("keys", "half_bits", "counter")
+
+    def __init__(self, keys: Tuple[int, ...], half_bits: int):
+        self.keys: Tuple[int, ...] = keys
+        self.half_bits: int = half_bits
+        self.counter: int = 0
+
+
+def _mix(value: int) -> int:
+    value = (value ^ (value >> 30)) * 0xBF58476D1CE4E5B9 & 0xFFFFFFFFFFFFFFFF
+    value = (value ^ (value >> 27)) * 0x94D049BB133111EB & 0xFFFFFFFFFFFFFFFF
+    return value ^ (value >> 31)
+
+
+class NoRepeatStrategy(SelectStrategy):
+    """
+    Draws files so that a group never sees a file twice before it saw the whole index.
+
+    Every group walks its own pseudo-random permutation of the positions of every shard. The permutation is a keyed
+    Feistel network over the next even power of two, cycle-walked down to the index size, so a group costs a
+    handful of ints no matter how large the index grows. A new permutation starts once a group went through the
+    whole index, or when the index outgrew the domain of the permutation.
+    """
+
+    ROUNDS = 4
+
+    def __init__(self):
+        self._cursors: Dict[Tuple[Tuple[str, ...], Optional[int]], _Cursor] = {}
+
+    def _new_cursor(self, size: int) -> _Cursor:
+        half_bits = max(1, (max(size - 1, 1).bit_length() + 1) // 2)
+        return _Cursor(tuple(getrandbits(64) for _ in range(self.ROUNDS)), half_bits)
+
+    def _permute(self, cursor: _Cursor, value: int) -> int:
+        mask = (1 << cursor.half_bits) - 1
+        left, right = value >> cursor.half_bits, value & mask
+        for key in cursor.keys:
+            left, right = right, left ^ (_mix(right ^ key) & mask)
+        return (left << cursor.half_bits) | right
+
+    def draw(self, index: FileIndex, group: Optional[int] = None) -> Tuple[Optional[int], str]:
+        size = len(index)
+        key = (index.roots, group)
+        cursor = self._cursors.get(key)
+        if cursor is None or cursor.counter >= size or size > 1 << (2 * cursor.half_bits):
+            cursor = self._cursors[key] = self._new_cursor(size)
+        position = self._permute(cursor, cursor.counter)
+        while position >= size:
+            position = self._permute(cursor, position)
+        cursor.counter += 1
+        return position, index.path_at(position)
@@ -0,0 +1,175 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import threading
+import time
+import warnings
+from typing import List, Dict, Set, Tuple
+
+from .select import Selector
+
+
+class Inotify(object):
+    """
+    A minimal ctypes binding of the Linux inotify API, watching directories for entries being added or removed.
+    """
+
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+
+    WATCH_MASK = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+    _EVENT = struct.Struct("iIII")
+
+    def __init__(self):
+        """
+        Initializes the inotify instance.
+
+        Raises:
+            OSError: If inotify is not available on this system.
+        """
+        if not sys.platform.startswith("linux"):
+            raise OSError(errno.ENOSYS, "inotify is only available on linux")
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._fd: int = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path: str) -> int:
+        """
+        Watches a directory and returns the watch descriptor.
+
+        Raises:
+            OSError: If the watch can not be added, for instance with ENOSPC once the watch limit is reached.
+        """
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), self.WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {path}")
+        return wd
+
+    def read(self, timeout: float) -> List[Tuple[int, int]]:
+        """
+        Waits up to the timeout for events and returns their watch descriptors and masks.
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + self._EVENT.size <= len(data):
+            wd, mask, _, name_len = self._EVENT.unpack_from(data, offset)
+            events.append((wd, mask))
+            offset += self._EVENT.size + name_len
+        return events
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+class IndexWatcher(threading.Thread):
+    """
+    Keeps the index of a `Selector` live from a background thread.
+
+    With inotify, every indexed directory is watched, and the directories that received events are refreshed
+    once no new event arrived for ``debounce`` seconds. Without inotify, or once the watch limit of the system is
+    reached, the whole index is refreshed every ``poll_interval`` seconds, which only lists the directories whose
+    mtime changed. Either way the index is persisted lazily, see `Selector.persist`.
+    """
+
+    def __init__(
+        self, selector: Selector, poll_interval: float = 300.0, debounce: float = 2.0, use_inotify: bool = True
+    ):
+        """
+        Initializes the IndexWatcher, call `start` to run it.
+
+        Args:
+            selector (Selector): The selector whose index is kept up to date.
+            poll_interval (float, optional): The interval of the full refreshes in seconds. Defaults to 300.
+            debounce (float, optional): The quiet time before changed directories are refreshed. Defaults to 2.
+            use_inotify (bool, optional): Whether to use inotify when available. Defaults to True.
+        """
+        super().__init__(name="PicEval-index-watcher", daemon=True)
+        self._selector: Selector = selector
+        self._poll_interval: float = poll_interval
+        self._debounce: float = debounce
+        self._use_inotify: bool = use_inotify
+        self._stopped = threading.Event()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def run(self) -> None:
+        if self._use_inotify:
+            try:
+                self._run_inotify()
+                return
+            except OSError as e:
+                warnings.warn(f"inotify unavailable, falling back to polling: {e}")
+        self._run_polling()
+
+    def _run_polling(self) -> None:
+        while not self._stopped.wait(self._poll_interval):
+            self._selector.refresh()
+            self._selector.persist()
+
+    def _run_inotify(self) -> None:
+        inotify = Inotify()
+        watched: Dict[str, int] = {}
+        by_wd: Dict[int, str] = {}
+
+        def sync_watches():
+            for dir_path in self._selector.dir_paths():
+                if dir_path not in watched:
+                    try:
+                        wd = inotify.add_watch(dir_path)
+                    except OSError as e:
+                        if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                            continue
+                        raise
+                    watched[dir_path] = wd
+                    by_wd[wd] = dir_path
+
+        try:
+            sync_watches()
+            dirty: Set[str] = set()
+            dirty_since = 0.0
+            overflow = False
+            last_full = time.monotonic()
+            while not self._stopped.is_set():
+                events = inotify.read(self._debounce if dirty or overflow else self._poll_interval)
+                if events and not dirty and not overflow:
+                    dirty_since = time.monotonic()
+                for wd, mask in events:
+                    if mask & Inotify.IN_Q_OVERFLOW:
+                        overflow = True
+                    elif mask & Inotify.IN_IGNORED:
+                        watched.pop(by_wd.pop(wd, None), None)
+                    elif wd in by_wd:
+                        dirty.add(by_wd[wd])
+                if events and time.monotonic() - dirty_since < 10 * self._debounce:
+                    continue
+                if overflow or time.monotonic() - last_full >= self._poll_interval:
+                    self._selector.refresh()
+                    last_full = time.monotonic()
+                elif dirty:
+                    self._selector.refresh(dirty)
+                dirty, overflow = set(), False
+                sync_watches()
+                self._selector.persist()
+        finally:
+            inotify.close()